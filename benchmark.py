@@ -0,0 +1,423 @@
+"""
+Офлайн-бенчмарк полного цикла main.py: ленты → сюжеты → LLM → картинка → Telegram → Gist.
+
+Все внешние сервисы подменяются локальными HTTP-заглушками в этом же процессе:
+GitHub Gist (GET/PATCH с ETag), RSS-ленты (генерируются из фикстур bench/fixtures/*.xml),
+Hugging Face Inference (потоковый chat completion и text-to-image) и Telegram Bot API.
+main.py направляется на них через GITHUB_API_URL / HF_INFERENCE_URL / TELEGRAM_API_URL,
+сам код конвейера не подменяется. Сеть и токены не нужны.
+
+Прогоняется сетка «число лент × записей в ленте × размер истории», для каждого прогона
+печатается время этапов (из METRICS), сквозное время, пропускная способность и пик памяти:
+
+    python benchmark.py
+    python benchmark.py --feeds 1,3,10 --entries 50,500 --history 10,100 --posts 3
+    python benchmark.py --latency llm=0.3,image=1.5 --failure-rate image=0.2 --output bench.json
+"""
+import os
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "fixtures")
+SERVICES = ("gist", "rss", "llm", "image", "telegram")
+ENTRY_STEP_MINUTES = 2  # записи в ленте идут с этим шагом от «сейчас» в прошлое: за час свежих ~30
+TOKEN_INTERVAL = 0.002  # пауза между SSE-чанками LLM, секунд
+TOKEN_CHARS = 12        # символов в одном чанке (~3 токена)
+
+# (подпись в таблице, имя спана в METRICS)
+STAGES = [
+    ("gist.load", "GistState.load"),
+    ("feeds", "fetch_feeds"),
+    ("keywords", "match_entries"),
+    ("stories", "pick_new_stories"),
+    ("llm", "generate_post_with_llm"),
+    ("image", "generate_image_with_hf"),
+    ("telegram", "send_to_telegram"),
+    ("gist.commit", "GistState.commit"),
+]
+
+LLM_REPLY = """Короче, сижу я вчера в гараже у Михалыча, чиним его «Ниву», которая третий год «почти на ходу». \
+По радио говорят: опять большие люди по телефону созвонились, чего-то там обсудили. Михалыч сразу ключ на 13 отложил \
+и говорит: «Вот увидишь, теперь бензин подешевеет». Я ему: «Михалыч, у тебя бензин последний раз дешевел, когда \
+ты его из комбината в канистре выносил». Посмеялись. А потом зашёл сосед Толян, сказал, что у них на вахте тоже \
+созвонились — начальник смены с диспетчером. Итог: премию перенесли на следующий квартал. Вот и думай теперь, \
+где большая политика, а где наша. Но «Нива» к вечеру завелась, это факт.
+
+PROMPT FOR IMAGE: [Two middle-aged men in worn work jackets repairing an old Lada Niva inside a cluttered \
+Soviet-era garage in a snowy Arctic industrial town, an old radio on a shelf, tools scattered on a bench, \
+warm lamp light, steam from a mug of tea]
+
+Надеюсь, пост получился в нужном стиле!"""
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+def parse_per_service(value, cast=float):
+    """'llm=0.5,image=2' -> {'llm': 0.5, 'image': 2.0}"""
+    result = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        name, _, number = part.partition("=")
+        if name not in SERVICES:
+            raise argparse.ArgumentTypeError(f"неизвестный сервис {name!r}, допустимы: {', '.join(SERVICES)}")
+        result[name] = cast(number)
+    return result
+
+
+# === FIXTURES ===
+def load_fixture_items():
+    """Записи из всех фикстур: список (заголовок, описание, ссылка, категория)."""
+    items = []
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if not name.endswith(".xml"):
+            continue
+        for item in ET.parse(os.path.join(FIXTURES_DIR, name)).iter("item"):
+            items.append((
+                item.findtext("title", ""),
+                item.findtext("description", ""),
+                item.findtext("link", ""),
+                item.findtext("category", ""),
+            ))
+    return items
+
+def render_feed(items, feed_no, entries, now):
+    """
+    RSS-лента из entries записей, новые сверху, с шагом ENTRY_STEP_MINUTES.
+    Каждая лента начинает с своей фикстуры, так что одни и те же события приходят из разных лент —
+    как у настоящих агентств, и кластеризация сюжетов работает на реальных дублях.
+    """
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel>',
+        f"<title>Bench feed {feed_no}</title><link>http://bench/{feed_no}</link>",
+    ]
+    for i in range(entries):
+        title, description, link, category = items[(feed_no * 7 + i) % len(items)]
+        round_no = i // len(items)
+        if round_no:
+            title = f"{title} ({round_no})"
+        published = format_datetime(now - timedelta(minutes=ENTRY_STEP_MINUTES * i))
+        parts.append(
+            f"<item><title>{escape(title)}</title><link>{escape(link)}?feed={feed_no}&amp;n={i}</link>"
+            f"<guid>{escape(link)}?feed={feed_no}&amp;n={i}</guid><pubDate>{published}</pubDate>"
+            f"<category>{escape(category)}</category><description>{escape(description)}</description></item>"
+        )
+    parts.append("</channel></rss>")
+    return "".join(parts).encode("utf-8")
+
+def render_image():
+    """JPEG 1024×1024, похожий по размеру на ответ FLUX (шум не даёт ему сжаться до пустяка)."""
+    from PIL import Image
+
+    noise = Image.effect_noise((1024, 1024), 40).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((1024, 1024)).convert("RGB")
+    buffer = io.BytesIO()
+    Image.blend(noise, gradient, 0.6).save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+def history_files(size):
+    """Стартовое содержимое Gist: size прошлых постов и промптов, остальные файлы пустые."""
+    posts = [
+        f"Пост №{n}. " + LLM_REPLY.split("PROMPT FOR IMAGE:")[0].replace("Михалыча", f"соседа №{n}")
+        for n in range(size)
+    ]
+    prompts = [f"Scene {n}: a man at a bus stop number {n} in a snowy town, reading a newspaper" for n in range(size)]
+    return {
+        "seen.json": "[]",
+        "history.json": json.dumps(posts, ensure_ascii=False),
+        "image_prompt.json": json.dumps(prompts, ensure_ascii=False),
+    }
+
+
+# === STAND-INS ===
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение (стрим LLM дочитан, таймаут) — для заглушки это норма
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandIns:
+    """
+    Заглушки всех внешних сервисов на одном ThreadingHTTPServer.
+    latency — задержка ответа по сервисам, failure_rate — доля ответов с ошибкой
+    (503, а для Telegram — 429 с retry_after, как у настоящего Bot API).
+    """
+
+    def __init__(self, latency, failure_rate, seed):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.image = render_image()
+        self.items = load_fixture_items()
+        self.server = QuietServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self, feeds, entries, history):
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            self.feeds = {f"/feeds/{n}.xml": render_feed(self.items, n, entries, now) for n in range(feeds)}
+            self.gist_files = history_files(history)
+            self.gist_version = 0
+            self.requests = {name: 0 for name in SERVICES}
+            self.failures = {name: 0 for name in SERVICES}
+            self.delivered = 0  # успешные sendPhoto/sendMessage: посты, которые реально дошли бы до канала
+
+    def close(self):
+        self.server.shutdown()
+
+    def _should_fail(self, service):
+        with self.lock:
+            self.requests[service] += 1
+            failed = self.rng.random() < self.failure_rate.get(service, 0.0)
+            self.failures[service] += failed
+        time.sleep(self.latency.get(service, 0.0))
+        return failed
+
+    def _handler(self):
+        stand_ins = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def _send(self, status, body=b"", content_type="application/json", headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, status, payload, headers=None):
+                self._send(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"), headers=headers)
+
+            def _fail(self, service):
+                if service == "telegram":
+                    self._json(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                     "parameters": {"retry_after": 1}})
+                else:
+                    self._json(503, {"error": f"{service} stand-in: injected failure"})
+
+            def _conditional(self, body, content_type):
+                etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._send(304, headers={"ETag": etag})
+                else:
+                    self._send(200, body, content_type, {"ETag": etag})
+
+            def do_GET(self):
+                if self.path.startswith("/gists/"):
+                    if stand_ins._should_fail("gist"):
+                        return self._fail("gist")
+                    with stand_ins.lock:
+                        files = {name: {"filename": name, "content": content, "truncated": False}
+                                 for name, content in stand_ins.gist_files.items()}
+                    self._conditional(json.dumps({"files": files}, ensure_ascii=False).encode("utf-8"),
+                                      "application/json")
+                elif self.path in stand_ins.feeds:
+                    if stand_ins._should_fail("rss"):
+                        return self._fail("rss")
+                    self._conditional(stand_ins.feeds[self.path], "application/rss+xml")
+                else:
+                    self._json(404, {"error": self.path})
+
+            def do_PATCH(self):
+                payload = json.loads(self._body() or b"{}")
+                if stand_ins._should_fail("gist"):
+                    return self._fail("gist")
+                with stand_ins.lock:
+                    for name, meta in payload.get("files", {}).items():
+                        stand_ins.gist_files[name] = meta["content"]
+                    stand_ins.gist_version += 1
+                self._json(200, {"files": {}})
+
+            def do_POST(self):
+                body = self._body()
+                if self.path.endswith("/chat/completions"):
+                    if stand_ins._should_fail("llm"):
+                        return self._fail("llm")
+                    self._stream_chat(json.loads(body).get("model", ""))
+                elif self.path.startswith("/models/"):
+                    if stand_ins._should_fail("image"):
+                        return self._fail("image")
+                    self._send(200, stand_ins.image, "image/jpeg")
+                elif self.path.startswith("/bot"):
+                    if stand_ins._should_fail("telegram"):
+                        return self._fail("telegram")
+                    method = self.path.rsplit("/", 1)[-1]
+                    result = {"message_id": stand_ins.requests["telegram"], "chat": {"id": -100}}
+                    if method == "sendPhoto":
+                        result["photo"] = [{"file_id": f"bench-photo-{result['message_id']}", "width": 1024}]
+                    if method in ("sendPhoto", "sendMessage"):
+                        with stand_ins.lock:
+                            stand_ins.delivered += 1
+                    self._json(200, {"ok": True, "result": result})
+                else:
+                    self._json(404, {"error": self.path})
+
+            def _stream_chat(self, model):
+                # SSE в формате OpenAI-совместимого роутера HF: чанки по TOKEN_CHARS символов, затем [DONE]
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    for start in range(0, len(LLM_REPLY), TOKEN_CHARS):
+                        chunk = {
+                            "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": model,
+                            "system_fingerprint": "",
+                            "choices": [{"index": 0, "delta": {"role": "assistant",
+                                                              "content": LLM_REPLY[start:start + TOKEN_CHARS]}}],
+                        }
+                        self.wfile.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+                        self.wfile.flush()
+                        time.sleep(TOKEN_INTERVAL)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # клиент дочитал промпт и закрыл стрим — так и задумано
+                self.close_connection = True
+
+        return Handler
+
+
+# === RUN ===
+def import_main(stand_ins):
+    """Импортирует main.py, направив все внешние адреса на заглушки."""
+    os.environ.update({
+        "GITHUB_API_URL": stand_ins.url,
+        "TELEGRAM_API_URL": stand_ins.url,
+        "HF_INFERENCE_URL": stand_ins.url,
+        "GIST_ID": "bench",
+        "GIST_TOKEN": "bench",
+        "HF_TOKEN": "bench",
+        "TELEGRAM_BOT_TOKEN": "bench",
+        "RUN_REPORT_PATH": "",
+        "PROMETHEUS_TEXTFILE": "",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    return main
+
+def run_pass(main, stand_ins, feeds, entries, history, posts, verbose=False):
+    """Один run_once на свежем состоянии заглушек и main. Возвращает время прохода, секунд."""
+    stand_ins.reset(feeds, entries, history)
+    main.RSS_SOURCES = [f"{stand_ins.url}/feeds/{n}.xml" for n in range(feeds)]
+    main.ORDERED_RSS_SOURCES = set(main.RSS_SOURCES)
+    main.POSTS_PER_RUN = posts
+    main.STATE = main.GistState(main.GIST_URL)
+    main.TELEGRAM_SENDER = main.TelegramSender()  # лимиты частоты по чатам — как в новом процессе
+    main.METRICS.reset()
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with output:
+        main.run_once()
+    return time.perf_counter() - started
+
+def run_scenario(main, stand_ins, feeds, entries, history, posts, verbose):
+    """
+    Время и пропускная способность — по проходу без tracemalloc (он замедляет разбор в разы),
+    пик памяти — по отдельному такому же проходу под tracemalloc.
+    """
+    elapsed = run_pass(main, stand_ins, feeds, entries, history, posts, verbose)
+    spans = main.METRICS.report()["spans"]
+    delivered = stand_ins.delivered
+    requests = dict(stand_ins.requests)
+    failures = {name: count for name, count in stand_ins.failures.items() if count}
+
+    tracemalloc.start()
+    run_pass(main, stand_ins, feeds, entries, history, posts)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "feeds": feeds,
+        "entries": entries,
+        "history": history,
+        "posts": delivered,  # по ответам заглушки Telegram, а не по числу взятых в работу сюжетов
+        "total_s": round(elapsed, 4),
+        "stages_s": {label: spans.get(span, {}).get("total_s", 0.0) for label, span in STAGES},
+        "posts_per_min": round(delivered / elapsed * 60, 2),
+        "entries_per_s": round(feeds * entries / elapsed, 1),
+        "peak_mb": round(peak / 2 ** 20, 2),
+        "requests": requests,
+        "failures": failures,
+    }
+
+def print_table(results):
+    columns = ["feeds", "entries", "history", "posts", "total_s"] + [label for label, _ in STAGES] + \
+              ["posts/min", "entries/s", "peak_mb"]
+    rows = [
+        [r["feeds"], r["entries"], r["history"], r["posts"], f"{r['total_s']:.3f}"]
+        + [f"{r['stages_s'][label]:.3f}" for label, _ in STAGES]
+        + [r["posts_per_min"], r["entries_per_s"], r["peak_mb"]]
+        for r in results
+    ]
+    widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+    for row in [columns] + rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+    failures = [r for r in results if r["failures"]]
+    for r in failures:
+        print(f"   {r['feeds']}×{r['entries']}×{r['history']}: отказы заглушек {r['failures']}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Офлайн-бенчмарк Vitok News Bot")
+    parser.add_argument("--feeds", type=parse_list, default=[1, 3, 10], help="число лент, через запятую")
+    parser.add_argument("--entries", type=parse_list, default=[50, 500], help="записей в каждой ленте")
+    parser.add_argument("--history", type=parse_list, default=[10, 100], help="постов в history.json")
+    parser.add_argument("--posts", type=int, default=1, help="POSTS_PER_RUN для каждого прогона")
+    parser.add_argument("--latency", type=parse_per_service, default={},
+                        help="задержка заглушек, секунд: llm=0.5,image=2 (сервисы: %s)" % ", ".join(SERVICES))
+    parser.add_argument("--failure-rate", type=parse_per_service, default={},
+                        help="доля ответов с ошибкой: image=0.2,telegram=0.1")
+    parser.add_argument("--seed", type=int, default=1, help="seed для внедрения ошибок")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не глушить вывод main.py")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    stand_ins = StandIns(args.latency, args.failure_rate, args.seed)
+    bot = import_main(stand_ins)
+    results = []
+    try:
+        # Прогрев: импорты huggingface_hub/PIL и первые соединения не должны попасть в первый сценарий
+        run_scenario(bot, stand_ins, 1, 10, 1, 1, verbose=False)
+        for feeds, entries, history in itertools.product(args.feeds, args.entries, args.history):
+            results.append(run_scenario(bot, stand_ins, feeds, entries, history, args.posts, args.verbose))
+    finally:
+        stand_ins.close()
+
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"📊 Результаты: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
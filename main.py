@@ -1,26 +1,83 @@
 import os
+import argparse
+import contextlib
+import copy
+import functools
+import inspect
+import signal
 import json
+import math
 import time
 import random
-import feedparser
-from datetime import datetime, timedelta
+import re
+import html
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import requests
-from huggingface_hub import InferenceClient
+from requests.adapters import HTTPAdapter
 import base64
-from PIL import Image
+import io
+import hashlib
+import struct
+from urllib.parse import parse_qsl, urlencode, urlsplit
 
 # === CONFIG ===
-TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
-HF_TOKEN = os.environ["HF_TOKEN"]
-FB_API_KEY = os.environ["FUSIONBRAIN_API_KEY"]
-GIST_TOKEN = os.environ["GIST_TOKEN"]
+# Секреты (TELEGRAM_BOT_TOKEN, HF_TOKEN, GIST_TOKEN) читаются при первом использовании через require_env,
+# поэтому модуль импортируется и `fetch` работает без них.
+# Тяжёлые зависимости (huggingface_hub, PIL, feedparser) импортируются внутри этапов, которые их используют.
 CHANNEL = os.environ.get("TELEGRAM_CHANNEL", "@notreviews")
+DRY_RUN = False  # --dry-run: ничего не пишем в Gist и не отправляем в Telegram
 
-RSS_SOURCES = [
+# Адреса внешних сервисов: переопределяются для локальных заглушек (benchmark.py)
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+HF_INFERENCE_URL = os.environ.get("HF_INFERENCE_URL", "").rstrip("/")  # пусто — штатный роутинг huggingface_hub
+
+def require_env(name):
+    """Обязательная переменная окружения; ошибка — только когда она действительно понадобилась."""
+    value = os.environ.get(name)
+    if not value:
+        raise RuntimeError(f"Не задана переменная окружения {name}")
+    return value
+
+DEFAULT_RSS_SOURCES = [
     "https://ria.ru/export/rss2/archive/index.xml",
     "https://tass.ru/rss/v2.xml",
     "https://lenta.ru/rss/",
 ]
+RSS_SOURCES = list(DEFAULT_RSS_SOURCES)
+if os.environ.get("RSS_SOURCES"):
+    RSS_SOURCES = [url.strip() for url in os.environ["RSS_SOURCES"].split(",") if url.strip()]
+FEED_TIMEOUT = (5, 15)  # (connect, read) секунд на одну RSS-ленту
+# Ленты, где записи точно идут от новых к старым: их читаем только до cutoff.
+# Явный список проверенных лент — ленты из RSS_SOURCES в окружении читаются целиком.
+ORDERED_RSS_SOURCES = set(DEFAULT_RSS_SOURCES)
+STALE_ENTRIES_TO_STOP = 3  # столько старых записей подряд — и дальше ленту не читаем
+
+# Ключевые слова по категориям. «*» на конце — основа слова с любым окончанием
+KEYWORDS = {
+    "politics": [
+        "политик*", "указ", "назнач*", "Совбез*", "Минобороны", "президент*", "выбор", "парламент*", "госдум*", "сенат*",
+    ],
+    "leaders": [
+        "Путин*", "Лавров*", "Шойгу", "Си", "Зеленск*", "Байден*", "Трамп*", "Ким", "Меркель", "Макрон*", "Додик*", "Медведев*", "Володин*",
+    ],
+    "countries": [
+        "Росси*", "США", "Кита*", "Украин*", "Северная Коре*", "Северной Коре*", "КНДР", "Европ*", "ЕС", "НАТО", "ООН", "ОПЕК",
+        "Беларус*", "Белорус*", "Казахстан*", "Турци*", "Турец*", "Иран*", "Израил*", "Палестин*", "Сири*", "Афганистан*",
+    ],
+    "organizations": [
+        "ООН", "ЕС", "НАТО", "ОПЕК", "МАГАТЭ", "СНГ", "БРИКС", "ШОС", "G7", "G20",
+    ],
+    "finance": [
+        "санкци*", "бирж*", "валют*", "доллар*", "евро", "золот*", "нефт*", "газ", "газа", "газу", "газом", "газов*", "торг*",
+        "рынок", "рынк*", "процент*", "ставк*", "дефицит*", "инфляци*", "долг*", "кредит*",
+    ],
+}
+KEYWORD_MAX_ENDING = 2  # сколько букв окончания допускаем после слова из 4+ букв
 
 SYSTEM_PROMPT_HERE = """
 Ты — Витёк из Кайеркана близ Норильска, работающий вахтой в посёлке Варандей. Тебе за 50 и всю жизнь ты провёл в тяжёлом труде: вахты, заводы, шахты. Сейчас ты вышел на пенсию и живёшь в своём захолустье. До райцентра 2 часа на ржавом "УАЗике"-буханке, интернет ловит раз в два дня. У тебя лёгкая контузия после падения с эстакады на Норильском комбинате — тогда ещё Норникель платил по-честному, а не как сейчас — копейки за вахту, весь твой мир — это вечная мерзлота от Варандея до Дудинки, а Москва где-то за облаками.
@@ -65,211 +122,1508 @@ USER_PROMPT_HERE = """
 PROMPT FOR IMAGE: [Краткое, структурированное описание сцены на английском языке, отражающее суть новости и лор Витька (провинциальный, бытовой). Опиши ключевых персонажей, их действия, окружение и важные детали. НЕ должно быть портретом.
 """
 
-# === GIST STATE MANAGEMENT ===
-GIST_ID = "5944017a021bcea90b63cf408a0324e5"
+# === CHANNELS ===
+# Каналы и персонажи. По умолчанию — один канал CHANNEL с Витьком. CHANNELS_FILE — JSON со списком каналов
+# и своими персонажами: ленты, сюжеты и картинка общие, текст генерируется для каждого персонажа отдельно.
+# Первый канал — основной: его пост задаёт промпт картинки.
+CHANNELS_FILE = os.environ.get("CHANNELS_FILE", "")
+DEFAULT_PERSONA = "vitok"
+LLM_FALLBACK_TEXT = "Батенька опять в новостях: {title}. А мне-то чё? У меня гараж есть. За Родину-мать не стыдно рвать! 🇷🇺"
+PERSONAS = {
+    DEFAULT_PERSONA: {"system_prompt": SYSTEM_PROMPT_HERE, "user_prompt": USER_PROMPT_HERE, "fallback": LLM_FALLBACK_TEXT},
+}
+CHANNELS = [{"chat_id": CHANNEL, "persona": DEFAULT_PERSONA}]
+
+def load_channels(path):
+    """
+    Читает каналы и персонажей из JSON:
+    {"personas": {"имя": {"system_prompt": "...", "user_prompt": "...", "fallback": "..."}},
+     "channels": [{"chat_id": "@channel", "persona": "имя"}, ...]}.
+    user_prompt — шаблон с {history_str}, {title}, {summary} (по умолчанию USER_PROMPT_HERE),
+    fallback — текст с {title} на случай отказа LLM. Возвращает (персонажи, каналы).
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    personas = dict(PERSONAS)
+    for name, persona in config.get("personas", {}).items():
+        if "system_prompt" not in persona:
+            raise ValueError(f"{path}: у персонажа {name} нет system_prompt")
+        personas[name] = {"user_prompt": USER_PROMPT_HERE, "fallback": LLM_FALLBACK_TEXT, **persona}
+    channels = []
+    for channel in config.get("channels", []):
+        persona = channel.get("persona", DEFAULT_PERSONA)
+        if persona not in personas:
+            raise ValueError(f"{path}: у канала {channel['chat_id']} неизвестный персонаж {persona}")
+        channels.append({"chat_id": str(channel["chat_id"]), "persona": persona})
+    return personas, channels or CHANNELS
+
+_channels_loaded = False
+_channels_lock = threading.Lock()
+
+def ensure_channels():
+    """
+    Подгружает CHANNELS_FILE при первом использовании, а не при импорте: битый или отсутствующий файл
+    не мешает импорту модуля и команде fetch, а ошибка всплывает там, где каналы нужны.
+    """
+    global PERSONAS, CHANNELS, _channels_loaded
+    with _channels_lock:
+        if not _channels_loaded:
+            if CHANNELS_FILE:
+                PERSONAS, CHANNELS = load_channels(CHANNELS_FILE)
+            _channels_loaded = True
 
-def load_seen():
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    headers = {"Authorization": f"token {GIST_TOKEN}"}
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            files = resp.json().get("files", {})
-            if "seen.json" in files:
-                content = files["seen.json"].get("content", "[]")
-                return set(json.loads(content))
-        return set()
-    except Exception as e:
-        print(f"⚠️ Ошибка загрузки seen.json из Gist: {e}")
-        return set()
-
-def save_seen(seen_set):
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    headers = {"Authorization": f"token {GIST_TOKEN}"}
-    payload = {
-        "files": {
-            "seen.json": {
-                "content": json.dumps(list(seen_set), ensure_ascii=False, indent=2)
+# === METRICS ===
+RUN_REPORT_PATH = os.environ.get("RUN_REPORT_PATH", "run_report.json")  # пусто — отчёт не пишем
+PROMETHEUS_TEXTFILE = os.environ.get("PROMETHEUS_TEXTFILE", "")  # путь для textfile collector node_exporter
+METRICS_PREFIX = "vitok_"
+
+
+class Metrics:
+    """
+    Лёгкая инструментация одного запуска: спаны (время функций), счётчики и gauges.
+    Спаны вешаются на все функции модуля автоматически (instrument_module), счётчики — вручную.
+    Потокобезопасно: этапы идут в пуле потоков.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.spans = {}     # имя -> {"count", "total_s", "max_s", "errors"}
+            self.counters = {}  # (имя, метки) -> значение
+            self.gauges = {}    # (имя, метки) -> значение
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, failed=False):
+        with self.lock:
+            span = self.spans.setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0, "errors": 0})
+            span["count"] += 1
+            span["total_s"] += seconds
+            span["max_s"] = max(span["max_s"], seconds)
+            span["errors"] += failed
+
+    def timed(self, func, name=None):
+        """Оборачивает функцию спаном с именем name (по умолчанию — __qualname__)."""
+        name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self.observe(name, time.perf_counter() - started, failed)
+        return wrapper
+
+    @staticmethod
+    def _format_key(name, labels):
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def report(self):
+        """Отчёт о запуске в виде словаря (для JSON)."""
+        with self.lock:
+            return {
+                "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                "duration_s": round(time.time() - self.started, 3),
+                "spans": {
+                    name: {**span, "total_s": round(span["total_s"], 4), "max_s": round(span["max_s"], 4)}
+                    for name, span in sorted(self.spans.items(), key=lambda kv: -kv[1]["total_s"])
+                },
+                "counters": {self._format_key(*key): value for key, value in sorted(self.counters.items())},
+                "gauges": {self._format_key(*key): value for key, value in sorted(self.gauges.items())},
             }
-        }
-    }
+
+    def prometheus(self):
+        """Отчёт в текстовом формате Prometheus."""
+        report = self.report()
+        lines = [
+            f"# TYPE {METRICS_PREFIX}run_duration_seconds gauge",
+            f"{METRICS_PREFIX}run_duration_seconds {report['duration_s']}",
+            f"# TYPE {METRICS_PREFIX}last_run_timestamp_seconds gauge",
+            f"{METRICS_PREFIX}last_run_timestamp_seconds {int(self.started)}",
+        ]
+        for suffix, field in (("span_seconds_total", "total_s"), ("span_max_seconds", "max_s"),
+                              ("span_calls_total", "count"), ("span_errors_total", "errors")):
+            lines.append(f"# TYPE {METRICS_PREFIX}{suffix} {'gauge' if field == 'max_s' else 'counter'}")
+            for name, span in report["spans"].items():
+                lines.append(f'{METRICS_PREFIX}{suffix}{{span="{name}"}} {span[field]}')
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+                    for (key_name, labels), value in sorted(values.items()):
+                        if key_name == name:
+                            lines.append(f"{METRICS_PREFIX}{self._format_key(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Пишет JSON-отчёт (RUN_REPORT_PATH) и, если задан, textfile для Prometheus."""
+        for path, content in ((RUN_REPORT_PATH, lambda: json.dumps(self.report(), ensure_ascii=False, indent=2)),
+                              (PROMETHEUS_TEXTFILE, self.prometheus)):
+            if not path:
+                continue
+            try:
+                # Через временный файл: textfile collector не должен увидеть файл наполовину записанным
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(content())
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"⚠️ Не удалось записать отчёт {path}: {e}")
+        if RUN_REPORT_PATH:
+            print(f"📊 Отчёт о запуске: {RUN_REPORT_PATH}")
+
+
+METRICS = Metrics()
+
+# Функции, методы (по __qualname__) и классы, которые не оборачиваем спаном: вызываются на каждый XML-элемент,
+# запись ленты, чанк, HTTP-запрос или пару сравниваемых объектов, рекурсивно. Каждый спан берёт общий лок METRICS,
+# поэтому их время видно только в спане вызывающего этапа.
+METRICS_SKIP = {
+    "_local_name", "_trie_pattern", "instrument_module", "Deadline", "current_deadline", "stage_deadline",
+    # HTTP: на каждый запрос и ответ (http_request, with_retries)
+    "http_session", "_count_http",
+    # Ленты и seen: на каждую запись (fetch_feed, match_entries, load_seen)
+    "_parse_date", "_clean_summary", "_normalize_title", "_normalize_link",
+    "_TeeReader.read", "KeywordMatcher.match",
+    "SeenStore._digest", "SeenStore._add_digest", "SeenStore._keys", "SeenStore._current_bucket",
+    "SeenStore.contains", "SeenStore.add",
+    # Сюжеты: на каждую новость и пару кандидатов (pick_new_stories, load_posted_stories)
+    "_story_tokens", "story_signature", "signature_similarity", "_lsh_keys", "StoryIndex",
+    "_encode_signature", "_decode_signature",
+    # История и промпты: на каждый пост истории или пару промптов (build_history_context, ensure_fresh_image_prompt)
+    "estimate_tokens", "make_history_digest", "_history_key", "prompt_similarity", "_prompt_tokens",
+    # LLM: на каждый токен (_stream_post)
+    "PostStreamParser.feed",
+}
+
+def instrument_module(namespace):
+    """
+    Вешает спаны METRICS на все функции и методы классов модуля (кроме генераторов и METRICS_SKIP).
+    Вызывается один раз в конце модуля, поэтому новые функции попадают в отчёт без изменений.
+    """
+    def wrap(func):
+        if func.__qualname__ in METRICS_SKIP or inspect.isgeneratorfunction(func):
+            return func
+        return METRICS.timed(func)
+
+    for name, obj in list(namespace.items()):
+        if getattr(obj, "__module__", None) != namespace["__name__"]:
+            continue
+        if inspect.isfunction(obj):
+            namespace[name] = wrap(obj)
+        elif inspect.isclass(obj) and obj is not Metrics and name not in METRICS_SKIP:
+            for attr, value in list(vars(obj).items()):
+                if attr.startswith("__"):
+                    continue
+                if isinstance(value, staticmethod):
+                    setattr(obj, attr, staticmethod(wrap(value.__func__)))
+                elif inspect.isfunction(value):
+                    setattr(obj, attr, wrap(value))
+
+def _count_http(resp, *args, **kwargs):
+    """Хук requests: число запросов и байты по хостам (тело стрима не трогаем — берём Content-Length)."""
+    host = urlsplit(resp.url).hostname or ""
+    METRICS.incr("http_requests_total", host=host, status=f"{resp.status_code // 100}xx")
+    METRICS.incr("http_response_bytes_total", int(resp.headers.get("Content-Length") or 0), host=host)
+    body = resp.request.body
+    if isinstance(body, (bytes, str)):
+        METRICS.incr("http_request_bytes_total", len(body), host=host)
+
+# === HTTP CLIENTS ===
+# Клиенты живут весь процесс: в режиме демона соединения (TLS) переиспользуются между циклами
+HTTP_POOL_SIZE = 16
+_clients_lock = threading.Lock()
+_http_session = None
+_inference_clients = {}
+
+def http_session():
+    """Общая requests.Session с пулом соединений (GitHub, RSS, Telegram)."""
+    global _http_session
+    with _clients_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.hooks["response"].append(_count_http)
+            _http_session = session
+        return _http_session
+
+def inference_client(model=None, timeout=None):
+    """
+    Долгоживущий InferenceClient на модель (HF_TOKEN берётся из окружения).
+    timeout — копия клиента с таймаутом под оставшийся бюджет этапа (сессия и заголовки общие).
+    """
+    from huggingface_hub import InferenceClient
+
+    with _clients_lock:
+        if model not in _inference_clients:
+            token = os.environ.get("HF_TOKEN")
+            if not HF_INFERENCE_URL:
+                client = InferenceClient(model=model, token=token)
+            elif model is None:
+                # chat_completion допишет /chat/completions
+                client = InferenceClient(base_url=f"{HF_INFERENCE_URL}/v1", token=token)
+            else:
+                client = InferenceClient(model=f"{HF_INFERENCE_URL}/models/{model}", token=token)
+            _inference_clients[model] = client
+        client = _inference_clients[model]
+    if timeout is not None:
+        client = copy.copy(client)
+        client.timeout = timeout
+    return client
+
+# === HTTP EXECUTION ===
+# Весь запуск ограничен RUN_DEADLINE_SECONDS, каждый этап — своим бюджетом STAGE_BUDGETS (но не дольше,
+# чем осталось у запуска). Таймауты запросов подрезаются под остаток бюджета, поэтому один медленный
+# сервис не растягивает запуск до таймаута джобы в Actions.
+RUN_DEADLINE_SECONDS = float(os.environ.get("RUN_DEADLINE_SECONDS", "600"))
+STAGE_BUDGETS = {  # секунд
+    "gist": 30,       # загрузка или запись снимка; на финальную запись бюджет зарезервирован
+    "feeds": 60,
+    "llm": 240,
+    "image": 240,
+    "telegram": 60,
+}
+HTTP_TIMEOUT = 10  # секунд на соединение и на чтение, если вызывающий не задал свой
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_BASE = 0.5  # секунд; пауза перед k-м повтором — случайная в [0, base·2^k] (full jitter)
+RETRY_BACKOFF_MAX = 8
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Через сколько секунд без ответа ленты отправляем второй такой же запрос (0 — не дублировать)
+FEED_HEDGE_AFTER = float(os.environ.get("FEED_HEDGE_AFTER", "2"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """Бюджет времени этапа или запуска исчерпан — повторять бессмысленно."""
+
+
+class Deadline:
+    """Момент, к которому этап должен закончиться; вложенный дедлайн не выходит за родительский."""
+
+    def __init__(self, seconds, parent=None, name="run"):
+        self.name = name
+        self.end = time.monotonic() + seconds
+        if parent is not None:
+            self.end = min(self.end, parent.end)
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+    def check(self, what):
+        """Бросает DeadlineExceeded, если время вышло."""
+        if self.remaining() <= 0:
+            METRICS.incr("deadline_exceeded_total", stage=self.name)
+            raise DeadlineExceeded(f"{what}: истёк бюджет времени ({self.name})")
+
+
+RUN_DEADLINE = None  # задаётся в начале run_once
+_stage_local = threading.local()  # дедлайн текущего этапа в этом потоке
+
+def current_deadline():
+    """Дедлайн текущего этапа в этом потоке, иначе — запуска."""
+    return getattr(_stage_local, "deadline", None) or RUN_DEADLINE or Deadline(RUN_DEADLINE_SECONDS)
+
+@contextlib.contextmanager
+def stage_deadline(name, final=False):
+    """
+    Бюджет этапа name на время блока: STAGE_BUDGETS[name], но не дольше дедлайна запуска.
+    final=True — финальная запись в Gist: на неё время зарезервировано, дедлайн запуска её не обрезает.
+    Дедлайн потоковый: в пулы потоков его передают явно (fetch_feeds).
+    """
+    previous = getattr(_stage_local, "deadline", None)
+    parent = None if final else current_deadline()
+    _stage_local.deadline = Deadline(STAGE_BUDGETS[name], parent, name)
     try:
-        resp = requests.patch(url, headers=headers, json=payload, timeout=10)
-        if resp.status_code == 200:
-            print("✅ seen.json обновлён в Gist")
-        else:
-            print(f"❌ Ошибка сохранения в Gist: {resp.status_code}")
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения в Gist: {e}")
+        yield _stage_local.deadline
+    finally:
+        _stage_local.deadline = previous
+
+def _retry_after(resp):
+    """Сколько просит подождать сервер: заголовок Retry-After или parameters.retry_after Telegram."""
+    if resp is None:
+        return None
+    try:
+        if resp.headers.get("Retry-After"):
+            return float(resp.headers["Retry-After"])
+        if resp.status_code == 429 and "json" in resp.headers.get("Content-Type", ""):
+            return float(resp.json()["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def _retry_delay(attempt, resp=None):
+    retry_after = _retry_after(resp)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+def _backoff(delay, target, reason):
+    METRICS.incr("retries_total", target=target, reason=reason)
+    print(f"🔁 {target}: {reason}, повтор через {delay:.1f} с")
+    time.sleep(delay)
+
+def http_request(method, url, timeout=HTTP_TIMEOUT, deadline=None, idempotent=None, **kwargs):
+    """
+    Запрос через общую сессию в пределах дедлайна (по умолчанию — текущего этапа).
+    Таймауты подрезаются под остаток бюджета. Повторы с паузой full jitter:
+    429 — всегда (запрос отклонён, не выполнен; пауза — сколько просит сервер),
+    5xx и обрывы — только для идемпотентных запросов, для остальных — лишь если не удалось соединиться.
+    Если пауза не помещается в бюджет, возвращается последний ответ (или пробрасывается ошибка).
+    """
+    deadline = deadline or current_deadline()
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    host = urlsplit(url).hostname or ""
+    for attempt in range(RETRY_ATTEMPTS):
+        deadline.check(f"{method} {host}")
+        remaining = deadline.remaining()
+        last = attempt == RETRY_ATTEMPTS - 1
+        try:
+            resp = http_session().request(method, url, timeout=(min(connect_timeout, remaining),
+                                                                 min(read_timeout, remaining)), **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            delay = _retry_delay(attempt)
+            if last or not (idempotent or isinstance(e, requests.ConnectTimeout)) or delay >= deadline.remaining():
+                raise
+            _backoff(delay, host, type(e).__name__)
+            continue
+        if last or resp.status_code not in RETRY_STATUSES or not (idempotent or resp.status_code == 429):
+            return resp
+        delay = _retry_delay(attempt, resp)
+        if delay >= deadline.remaining():
+            return resp
+        resp.close()
+        _backoff(delay, host, str(resp.status_code))
+
+def _transient(error):
+    """Ошибка вызова Hugging Face, которую имеет смысл повторить."""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status in RETRY_STATUSES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, TimeoutError))
+
+def with_retries(call, target, deadline=None):
+    """
+    Повторяет call() (вызов InferenceClient) при временных ошибках в пределах дедлайна.
+    call получает остаток бюджета в секундах — его передают клиенту как timeout.
+    """
+    deadline = deadline or current_deadline()
+    for attempt in range(RETRY_ATTEMPTS):
+        deadline.check(target)
+        try:
+            return call(deadline.remaining())
+        except Exception as e:
+            delay = _retry_delay(attempt, getattr(e, "response", None))
+            if attempt == RETRY_ATTEMPTS - 1 or not _transient(e) or delay >= deadline.remaining():
+                raise
+            _backoff(delay, target, type(e).__name__)
+
+def _discard_result(discard, future):
+    if discard and not future.cancelled() and future.exception() is None:
+        discard(future.result())
+
+def hedged(call, hedge_after, discard=None):
+    """
+    Hedged request: если call() не вернулся за hedge_after секунд, запускается второй такой же вызов
+    и берётся первый успешный результат; лишний отдаётся в discard (например, закрыть ответ).
+    Срезает хвост задержек от зависшего соединения ценой редкого лишнего запроса.
+    """
+    if not hedge_after:
+        return call()
+    pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        done, pending = wait({pool.submit(call)}, timeout=hedge_after)
+        if not done:
+            METRICS.incr("hedged_requests_total")
+            pending.add(pool.submit(call))
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    for other in (done | pending) - {future}:
+                        other.add_done_callback(functools.partial(_discard_result, discard))
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    finally:
+        pool.shutdown(wait=False)
+
+# === GIST STATE MANAGEMENT ===
+GIST_ID = os.environ.get("GIST_ID", "5944017a021bcea90b63cf408a0324e5")
+GIST_URL = f"{GITHUB_API_URL}/gists/{GIST_ID}"
+HISTORY_MAX_LENGTH = 10  # сколько последних текстов/промптов храним в истории
+
+
+class GistState:
+    """
+    Снимок состояния бота из Gist (seen.json, history.json, image_prompt.json и т.д.).
+    Gist читается один раз за запуск, файлы отдаются из памяти, а все изменения
+    уходят одним multi-file PATCH в commit().
+    Перед записью снимок проверяется условным GET по ETag: если Gist успели изменить
+    (например, параллельный запуск), снимок перечитывается и изменения применяются заново.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.remote = {}   # имя файла -> содержимое в Gist на момент снимка
+        self.files = {}    # имя файла -> текущее содержимое (с нашими изменениями)
+        self.updates = []  # (имя файла, функция, default) — для повторного применения при конфликте
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def _headers(self, write=False):
+        # Читать Gist можно и без токена (fetch, dry-run), писать — только с ним
+        headers = {"Accept": "application/vnd.github+json"}
+        token = require_env("GIST_TOKEN") if write else os.environ.get("GIST_TOKEN")
+        if token:
+            headers["Authorization"] = f"token {token}"
+        return headers
+
+    def _apply_snapshot(self, resp):
+        # Снимок и ETag принимаются только целиком: если докачка файла упала, ETag остаётся старым,
+        # и commit() не примет неполный снимок за актуальный (304) и не затрёт файлы в Gist
+        remote = {}
+        for name, meta in resp.json().get("files", {}).items():
+            content = meta.get("content", "")
+            # Файлы больше ~1 МБ API отдаёт обрезанными — докачиваем по raw_url
+            if meta.get("truncated") and meta.get("raw_url"):
+                raw = http_request("GET", meta["raw_url"], headers=self._headers())
+                raw.raise_for_status()
+                content = raw.text
+            remote[name] = content
+        self.remote = remote
+        self.files = dict(remote)
+        self.etag = resp.headers.get("ETag")
+
+    def load(self):
+        """
+        Загружает снимок Gist (один GET). Если снимок уже в памяти (режим демона) —
+        только условный GET по ETag: при 304 ничего не скачивается и не парсится.
+        """
+        with self.lock:
+            try:
+                self._revalidate()
+            except Exception as e:
+                print(f"⚠️ Ошибка загрузки состояния из Gist: {e}")
+            self.loaded = True
+
+    def get(self, name, default):
+        """Возвращает распарсенное содержимое файла из снимка (или default)."""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return self._read(name, default)
+
+    def _read(self, name, default):
+        content = self.files.get(name)
+        if not content:
+            return default
+        try:
+            return json.loads(content)
+        except ValueError as e:
+            print(f"⚠️ Повреждён {name} в Gist: {e}")
+            return default
+
+    def update(self, name, func, default):
+        """
+        Применяет func(старое значение) -> новое значение к файлу в снимке.
+        В Gist ничего не пишется до commit().
+        """
+        with self.lock:
+            self._write(name, func(self.get(name, default)))
+            self.updates.append((name, func, default))
+
+    def _write(self, name, value):
+        self.files[name] = json.dumps(value, ensure_ascii=False, indent=2)
+
+    def _changed(self):
+        return {
+            name: {"content": content}
+            for name, content in self.files.items()
+            if self.remote.get(name) != content
+        }
+
+    def _revalidate(self):
+        """
+        Условный GET по ETag: 304 — Gist не менялся с момента снимка.
+        Иначе перечитываем снимок и заново применяем накопленные изменения.
+        """
+        headers = self._headers()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        resp = http_request("GET", self.url, headers=headers)
+        if resp.status_code == 304:
+            return
+        resp.raise_for_status()
+        if self.updates:
+            print("⚠️ Gist изменился с момента загрузки — применяю изменения к свежему снимку")
+        self._apply_snapshot(resp)
+        for name, func, default in self.updates:
+            self._write(name, func(self._read(name, default)))
+
+    def commit(self):
+        """Записывает все изменённые файлы в Gist одним PATCH."""
+        with self.lock:
+            if DRY_RUN:
+                print(f"🧪 Dry-run: в Gist не пишу ({', '.join(sorted(self._changed())) or 'без изменений'})")
+                return
+            if not self.loaded or not self._changed():
+                print("✅ Состояние в Gist не изменилось — запись не нужна")
+                return
+            try:
+                self._revalidate()
+                changed = self._changed()
+                if not changed:
+                    return
+                # PATCH с полным содержимым файлов идемпотентен — повтор не задвоит изменения
+                resp = http_request("PATCH", self.url, headers=self._headers(write=True), json={"files": changed},
+                                    idempotent=True)
+                METRICS.incr("gist_written_bytes_total", sum(len(f["content"].encode()) for f in changed.values()))
+                if resp.status_code == 200:
+                    print(f"✅ Gist обновлён: {', '.join(sorted(changed))}")
+                    self.remote = dict(self.files)
+                    self.updates = []
+                    self.etag = resp.headers.get("ETag")
+                else:
+                    print(f"❌ Ошибка сохранения в Gist: {resp.status_code}")
+            except Exception as e:
+                print(f"⚠️ Ошибка сохранения в Gist: {e}")
+
+
+STATE = GistState(GIST_URL)
+
+
+# === SEEN NEWS ===
+SEEN_TTL_HOURS = 72  # сколько часов помним обработанную новость
+SEEN_DIGEST_SIZE = 8  # байт на хэш заголовка/ссылки
+
+
+class SeenStore:
+    """
+    Компактное хранилище уже обработанных новостей (seen.json).
+    Вместо полных заголовков хранятся 8-байтовые хэши нормализованных заголовка и ссылки,
+    разложенные по часовым корзинам; корзины старше SEEN_TTL_HOURS выбрасываются,
+    поэтому размер файла не растёт со временем.
+    Формат в Gist: {"version": 2, "buckets": {"<номер часа>": "<base64 склеенных хэшей>"}}.
+    Старый формат (список заголовков) переносится в текущую корзину.
+    """
+
+    def __init__(self, data=None):
+        self.buckets = {}  # номер часа -> set(хэшей)
+        self.digests = set()  # все хэши для быстрой проверки
+        self.changed = False
+        if isinstance(data, list):
+            for title in data:
+                self._add_digest(self._current_bucket(), self._digest("t", _normalize_title(title)))
+        elif isinstance(data, dict):
+            for bucket, encoded in data.get("buckets", {}).items():
+                raw = base64.b64decode(encoded)
+                for i in range(0, len(raw), SEEN_DIGEST_SIZE):
+                    self._add_digest(int(bucket), raw[i:i + SEEN_DIGEST_SIZE])
+
+    @staticmethod
+    def _current_bucket():
+        return int(time.time() // 3600)
+
+    @staticmethod
+    def _digest(kind, value):
+        return hashlib.blake2b(f"{kind}:{value}".encode(), digest_size=SEEN_DIGEST_SIZE).digest()
+
+    def _keys(self, title, link):
+        keys = [self._digest("t", _normalize_title(title))]
+        if link:
+            keys.append(self._digest("l", _normalize_link(link)))
+        return keys
+
+    def _add_digest(self, bucket, digest):
+        self.buckets.setdefault(bucket, set()).add(digest)
+        self.digests.add(digest)
+
+    def contains(self, title, link=""):
+        """True, если новость с таким заголовком или ссылкой уже обрабатывалась."""
+        return any(key in self.digests for key in self._keys(title, link))
+
+    def add(self, title, link=""):
+        bucket = self._current_bucket()
+        for key in self._keys(title, link):
+            if key not in self.digests:
+                self._add_digest(bucket, key)
+                self.changed = True
+
+    def merged_dump(self, other_data):
+        """Объединяет с другим снимком seen.json, выбрасывает устаревшие корзины и сериализует."""
+        merged = SeenStore(other_data)
+        for bucket, digests in self.buckets.items():
+            for digest in digests:
+                merged._add_digest(bucket, digest)
+        oldest = self._current_bucket() - SEEN_TTL_HOURS
+        return {
+            "version": 2,
+            "buckets": {
+                str(bucket): base64.b64encode(b"".join(sorted(digests))).decode()
+                for bucket, digests in sorted(merged.buckets.items())
+                if bucket > oldest
+            },
+        }
+
+
+def _normalize_title(title):
+    # Регистр, «ё», пунктуация и лишние пробелы не должны делать заголовок «новым»
+    return " ".join(re.sub(r"[^\w\s]", " ", title.lower().replace("ё", "е")).split())
+
+def _normalize_link(link):
+    # Схема, фрагмент и метки utm_* ссылку «новой» не делают, а остальной query — часть адреса
+    # (news.php?id=1 и news.php?id=2 — разные новости); параметры сортируются
+    parts = urlsplit(link.strip())
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not key.lower().startswith("utm_"))
+    normalized = f"{parts.netloc.lower()}{parts.path.rstrip('/')}"
+    return f"{normalized}?{urlencode(query)}" if query else normalized
+
+def load_seen():
+    return SeenStore(STATE.get("seen.json", []))
+
+def save_seen(seen):
+    if not seen.changed:
+        return
+    # Объединение, а не перезапись: при конфликте не теряем чужие записи
+    STATE.update("seen.json", seen.merged_dump, [])
+
+def _append_limited(items, item):
+    return (items + [item])[-HISTORY_MAX_LENGTH:]
 
 # === IMAGE PROMPTS HISTORY MANAGEMENT ===
 def load_image_prompts_history():
     """
-    Загружает историю предыдущих промптов для изображений из Gist.
+    Возвращает историю предыдущих промптов для изображений из снимка Gist.
     Возвращает список строк (последние N промптов).
     """
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    headers = {"Authorization": f"token {GIST_TOKEN}"}
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            files = resp.json().get("files", {})
-            # Используем имя файла, которое ты создал
-            if "image_prompt.json" in files:
-                content = files["image_prompt.json"].get("content", "[]")
-                history_list = json.loads(content)
-                # Возвращаем список строк (промптов)
-                return history_list
-        return []  # Если файла нет или ошибка — возвращаем пустой список
-    except Exception as e:
-        print(f"⚠️ Ошибка загрузки image_prompt.json из Gist: {e}")
-        return []
+    return STATE.get("image_prompt.json", [])
 
 def save_image_prompt_to_history(new_prompt):
     """
-    Добавляет новый промпт для изображения в историю и сохраняет её в Gist.
+    Добавляет новый промпт для изображения в историю (запишется в Gist при STATE.commit()).
     new_prompt: строка — новый промпт.
     """
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    headers = {"Authorization": f"token {GIST_TOKEN}"}
+    STATE.update("image_prompt.json", lambda history: _append_limited(history, new_prompt), [])
 
-    # Загрузить текущую историю промптов
-    current_history = load_image_prompts_history()
+# === NEWS PARSING ===
+def _local_name(tag):
+    # "{http://www.w3.org/2005/Atom}entry" -> "entry"
+    return tag.rsplit("}", 1)[-1]
 
-    # Добавить новый промпт в начало списка (или в конец — как удобнее)
-    current_history.append(new_prompt)
+def _clean_summary(text):
+    """Убирает HTML-теги и сущности из описания новости."""
+    return " ".join(html.unescape(re.sub(r"<[^>]+>", " ", text or "")).split())
 
-    # Ограничить размер истории (например, последние 10 промптов)
-    max_history_length = 10
-    if len(current_history) > max_history_length:
-        current_history = current_history[-max_history_length:]  # Оставить только последние N
+def _parse_date(value):
+    """Дата RSS (RFC 822) или Atom (ISO 8601) -> datetime в UTC; None, если не разобрать."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
 
-    # Подготовить payload для обновления
-    payload = {
-        "files": {
-            "image_prompt.json": {
-                "content": json.dumps(current_history, ensure_ascii=False, indent=2)
-            }
+class _TeeReader:
+    """
+    Обёртка над потоком ответа: запоминает прочитанное, чтобы при битом XML отдать всё в feedparser.
+    Копится не больше MAX_BUFFER_BYTES: на большой ленте буфер выбрасывается, и read_all возвращает None
+    (тогда ленту для feedparser нужно скачать заново).
+    Перед каждым чтением сверяется с дедлайном: лента, отдающая байты по капле, не держит этап дольше бюджета.
+    """
+
+    READ_ALL_CHUNK = 64 * 1024
+    MAX_BUFFER_BYTES = 2 * 1024 * 1024
+
+    def __init__(self, raw, deadline):
+        self.raw = raw
+        self.deadline = deadline
+        self.chunks = []
+        self.size = 0
+
+    def read(self, size=-1):
+        self.deadline.check("чтение ленты")
+        chunk = self.raw.read(size)
+        if self.chunks is not None:
+            self.size += len(chunk)
+            if self.size > self.MAX_BUFFER_BYTES:
+                self.chunks = None
+            else:
+                self.chunks.append(chunk)
+        return chunk
+
+    def read_all(self):
+        """Дочитывает поток и возвращает весь ответ или None, если буфер переполнился."""
+        if self.chunks is None:
+            return None
+        while self.read(self.READ_ALL_CHUNK):
+            if self.chunks is None:
+                return None
+        return b"".join(self.chunks)
+
+def iter_feed_entries(stream):
+    """
+    Потоковый разбор RSS 2.0 / Atom: записи отдаются по мере чтения,
+    без построения всего документа в памяти.
+    Запись: {"title", "summary", "link", "published"}.
+    """
+    stack = []
+    for event, elem in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+        stack.pop()
+        if _local_name(elem.tag) not in ("item", "entry"):
+            continue
+
+        fields = {}
+        for child in elem:
+            name = _local_name(child.tag)
+            if name == "link" and child.get("href"):
+                if child.get("rel", "alternate") == "alternate":
+                    fields["link"] = child.get("href")
+            elif name not in fields:
+                fields[name] = (child.text or "").strip()
+
+        yield {
+            "title": fields.get("title", ""),
+            "summary": _clean_summary(fields.get("description") or fields.get("summary") or fields.get("content")),
+            "link": fields.get("link", ""),
+            "published": _parse_date(fields.get("pubDate") or fields.get("published")
+                                     or fields.get("updated") or fields.get("date")),
+        }
+        # Освобождаем уже разобранную запись
+        if stack:
+            stack[-1].remove(elem)
+
+def _feedparser_entries(content):
+    """Запасной разбор через feedparser (терпим к кривому XML, но строит весь документ)."""
+    import feedparser
+
+    for entry in feedparser.parse(content).entries:
+        published = entry.get("published_parsed") or entry.get("updated_parsed")
+        yield {
+            "title": entry.get("title", ""),
+            "summary": _clean_summary(entry.get("summary", "")),
+            "link": entry.get("link", ""),
+            "published": datetime(*published[:6], tzinfo=timezone.utc) if published else None,
         }
-    }
 
-    try:
-        resp = requests.patch(url, headers=headers, json=payload, timeout=10)
-        if resp.status_code == 200:
-            print("✅ image_prompt.json обновлён в Gist")
-        else:
-            print(f"❌ Ошибка сохранения image_prompt.json: {resp.status_code}")
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения image_prompt.json: {e}")
+def _collect_fresh(entries, cutoff, ordered):
+    """
+    Отбирает записи не старше cutoff. Для лент, отсортированных от новых к старым,
+    чтение прекращается после STALE_ENTRIES_TO_STOP старых записей подряд.
+    """
+    fresh = []
+    stale_in_row = 0
+    for entry in entries:
+        if entry["published"] is None:
+            continue
+        if entry["published"] < cutoff:
+            stale_in_row += 1
+            if ordered and stale_in_row >= STALE_ENTRIES_TO_STOP:
+                break
+            continue
+        stale_in_row = 0
+        fresh.append(entry)
+    return fresh
 
-# === NEWS PARSING ===
-def fetch_political_news(hours=1):
-    keywords = [
-    # Политика
-    "политик", "указ", "назнач", "Совбез", "Минобороны", "президент", "выборы", "парламент", "госдума", "сенат",
-    # Фамилии лидеров
-    "Путин", "Лавров", "Шойгу", "Си", "Зеленский", "Байден", "Трамп", "Ким", "Меркель", "Макрон", "Додик", "Медведев", "Володин",
-    # Страны
-    "Россия", "США", "Китай", "Украина", "Северная Корея", "Европа", "ЕС", "НАТО", "ООН", "ОПЕК", "Беларусь", "Казахстан", "Турция", "Иран", "Израиль", "Палестина", "Сирия", "Афганистан",
-    # Организации
-    "ООН", "ЕС", "НАТО", "ОПЕК", "МАГАТЭ", "СНГ", "БРИКС", "ШОС", "G7", "G20",
-    # Финансы
-    "санкции", "биржа", "валюта", "доллар", "евро", "золото", "нефть", "газ", "торги", "рынок", "процент", "ставка", "дефицит", "инфляция", "долг", "кредит"
-]
+def fetch_feed(url, validators, cutoff, deadline):
+    """
+    Скачивает одну RSS-ленту условным GET (ETag / Last-Modified из прошлого запуска)
+    и потоково разбирает её до cutoff, не дольше deadline.
+    Если лента не ответила за FEED_HEDGE_AFTER секунд, параллельно уходит второй такой же запрос.
+    Возвращает (записи, новые валидаторы); записи = None, если лента не изменилась (304).
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("modified"):
+        headers["If-Modified-Since"] = validators["modified"]
+
+    request = functools.partial(http_request, "GET", url, headers=headers, timeout=FEED_TIMEOUT,
+                                deadline=deadline, stream=True)
+    with hedged(request, FEED_HEDGE_AFTER, discard=requests.Response.close) as resp:
+        if resp.status_code == 304:
+            return None, validators
+        resp.raise_for_status()
+
+        new_validators = {}
+        if resp.headers.get("ETag"):
+            new_validators["etag"] = resp.headers["ETag"]
+        if resp.headers.get("Last-Modified"):
+            new_validators["modified"] = resp.headers["Last-Modified"]
+
+        resp.raw.decode_content = True
+        stream = _TeeReader(resp.raw, deadline)
+        try:
+            entries = _collect_fresh(iter_feed_entries(stream), cutoff, url in ORDERED_RSS_SOURCES)
+        except ET.ParseError as e:
+            print(f"⚠️ {url}: потоковый разбор не удался ({e}), разбираю через feedparser")
+            content = stream.read_all()
+            if content is None:
+                # Лента больше буфера — скачиваем её ещё раз целиком
+                content = http_request("GET", url, timeout=FEED_TIMEOUT, deadline=deadline).content
+            entries = _collect_fresh(_feedparser_entries(content), cutoff, ordered=False)
+    return entries, new_validators
+
+def fetch_feeds(urls, cutoff):
+    """
+    Параллельно скачивает все ленты (время ≈ самой медленной ленте, а не сумме).
+    Возвращает список (url, записи не старше cutoff) только для изменившихся лент.
+    Валидаторы для условного GET хранятся в feeds.json в Gist.
+    """
+    cache = STATE.get("feeds.json", {})
+    deadline = current_deadline()  # потоки пула не видят дедлайн этапа — передаём явно
+    results = []
+    updated = {}
+    with ThreadPoolExecutor(max_workers=len(urls) or 1) as pool:
+        futures = [(url, pool.submit(fetch_feed, url, cache.get(url, {}), cutoff, deadline)) for url in urls]
+        for url, future in futures:
+            try:
+                entries, validators = future.result()
+            except Exception as e:
+                print(f"Ошибка загрузки {url}: {e}")
+                METRICS.incr("feeds_total", result="error")
+                continue
+            updated[url] = validators
+            if entries is None:
+                print(f"💤 {url} не изменилась (304)")
+                METRICS.incr("feeds_total", result="not_modified")
+                continue
+            METRICS.incr("feeds_total", result="fetched")
+            METRICS.incr("feed_entries_total", len(entries))
+            results.append((url, entries))
+
+    if updated:
+        STATE.update("feeds.json", lambda old: {**old, **updated}, {})
+    return results
+
+def _trie_pattern(node):
+    """
+    Regex из префиксного дерева слов: общие начала не перебираются заново,
+    поэтому проверка не замедляется линейно с ростом списка слов.
+    """
+    branches = [re.escape(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    # "" — конец слова в этом узле: продолжение необязательно (жадно, длинные слова первыми)
+    return f"(?:{body})?" if "" in node else body
+
+class KeywordMatcher:
+    """
+    Поиск ключевых слов одним скомпилированным regex (собирается один раз при старте).
+    Совпадение только с начала слова и без учёта регистра: короткие слова вроде «Си» или «Ким»
+    не цепляются за «Сибирь» и «Кимры». Слову из 4+ букв разрешено окончание до
+    KEYWORD_MAX_ENDING букв («Шойгу», «Меркель»), слово со «*» на конце — основа с любым окончанием
+    («Росси*» ловит «России» и «Российский», «Кита*» — «Китая» и «Китайский»).
+    """
+
+    def __init__(self, keywords):
+        self.terms = {}  # слово в нижнем регистре -> (слово, допустимая длина окончания, категории)
+        for category, words in keywords.items():
+            for word in words:
+                word, stem = word.rstrip("*"), word.endswith("*")
+                max_ending = float("inf") if stem else (KEYWORD_MAX_ENDING if len(word) >= 4 else 0)
+                _, known_ending, categories = self.terms.get(word.lower(), (word, 0, set()))
+                self.terms[word.lower()] = (word, max(max_ending, known_ending), categories | {category})
+
+        trie = {}
+        for key in self.terms:
+            node = trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[""] = {}
+        self.pattern = re.compile(rf"(?<!\w)({_trie_pattern(trie)})(\w*)", re.IGNORECASE)
+
+    def match(self, *texts):
+        """
+        Возвращает (совпавшие слова, их категории, score). Слово берётся в форме из текста
+        (первое вхождение), чтобы по основам вроде «Росси» тема читалась как «России».
+        score = число разных слов словаря + число разных категорий — чем больше, тем новость «политичнее».
+        """
+        words, categories = {}, set()
+        for text in texts:
+            for m in self.pattern.finditer(text):
+                key = m.group(1).lower()
+                _, max_ending, word_categories = self.terms[key]
+                if len(m.group(2)) <= max_ending:
+                    words.setdefault(key, m.group(0))
+                    categories |= word_categories
+        return sorted(words.values()), sorted(categories), len(words) + len(categories)
+
+KEYWORD_MATCHER = KeywordMatcher(KEYWORDS)
+
+def match_entries(entries, seen_titles):
+    """
+    Отбирает из записей одной ленты новые новости с ключевыми словами и помечает их увиденными.
+    Один спан на ленту: KeywordMatcher.match и проверки SeenStore на каждую запись в METRICS не попадают.
+    """
     fresh = []
-    cutoff = datetime.now() - timedelta(hours=hours)
+    for entry in entries:
+        title = entry["title"]
+        summary = entry["summary"]
+        if seen_titles.contains(title, entry["link"]):
+            continue
+        words, categories, score = KEYWORD_MATCHER.match(title, summary)
+        if words:
+            fresh.append({
+                "title": title,
+                "summary": summary[:300],
+                "link": entry["link"],
+                "keywords": words,
+                "categories": categories,
+                "score": score,
+                "time": int(entry["published"].timestamp()),
+            })
+            seen_titles.add(title, entry["link"])
+    return fresh
 
-    for url in RSS_SOURCES:
+def fetch_political_news(seen_titles, hours=1):
+    fresh = []
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=hours)
+
+    for url, entries in fetch_feeds([url.strip() for url in RSS_SOURCES], cutoff):
         try:
-            feed = feedparser.parse(url.strip())
-            for entry in feed.entries:
-                pub = datetime(*entry.published_parsed[:6])
-                if pub < cutoff:
-                    continue
-                title = entry.title
-                summary = entry.get("summary", "")
-                if title in seen_titles:
-                    continue
-                if any(kw in title or kw in summary for kw in keywords):
-                    fresh.append({
-                        "title": title,
-                        "summary": summary[:300],
-                        "link": entry.link
-                    })
-                    seen_titles.add(title)
+            fresh.extend(match_entries(entries, seen_titles))
         except Exception as e:
             print(f"Ошибка парсинга {url}: {e}")
+
+    # Самые релевантные новости — первыми
+    fresh.sort(key=lambda item: item["score"], reverse=True)
+    METRICS.gauge("news_fresh", len(fresh))
     return fresh
 
+# === STORY CLUSTERING ===
+MINHASH_PERMUTATIONS = 64
+LSH_ROWS = 3  # строк в полосе LSH: 21 полоса по 3 — при сходстве 0.5 пара попадает в кандидаты в ~94% случаев
+# Оценка сходства Жаккара, с которой новости считаются одним сюжетом. Разные события с одинаковым
+# «агентским» началом («… заявил журналистам, что …») дают до ~0.4, одно событие у разных агентств — 0.4–0.6.
+# Ошибка в сторону склейки дороже: такой сюжет уже в seen и пропадает насовсем, а несклеенный дубль — лишь повтор
+NEAR_DUPLICATE_THRESHOLD = 0.5
+POSTED_STORIES_TTL_HOURS = 48  # сколько часов помним сигнатуры опубликованных сюжетов
+
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20251114)  # фиксированное зерно: сигнатуры должны совпадать между запусками
+MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+def _story_tokens(text):
+    # Грубый стемминг: первые 5 букв слов длиннее 3 букв — «Трамп/Трампом», «телефон/телефонный» совпадут
+    return {word[:5] for word in re.findall(r"\w+", text.lower().replace("ё", "е")) if len(word) > 3}
+
+def story_signature(title, summary):
+    """MinHash-сигнатура новости (список из MINHASH_PERMUTATIONS 32-битных чисел) или None."""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "big")
+        for token in _story_tokens(f"{title} {summary}")
+    ]
+    if not hashes:
+        return None
+    return [min((a * h + b) % _MINHASH_PRIME for h in hashes) & 0xFFFFFFFF for a, b in MINHASH_PARAMS]
+
+def signature_similarity(sig_a, sig_b):
+    """Оценка сходства Жаккара по двум MinHash-сигнатурам."""
+    return sum(a == b for a, b in zip(sig_a, sig_b)) / len(sig_a)
+
+def _lsh_keys(sig):
+    # Только полные полосы: неполная последняя полоса из 1 числа совпадала бы почти у всех
+    return [(i, tuple(sig[i:i + LSH_ROWS])) for i in range(0, len(sig) - LSH_ROWS + 1, LSH_ROWS)]
+
+class StoryIndex:
+    """LSH-индекс сигнатур: поиск похожих без попарного сравнения со всеми."""
+
+    def __init__(self):
+        self.signatures = []
+        self.buckets = {}
+
+    def add(self, sig):
+        idx = len(self.signatures)
+        self.signatures.append(sig)
+        for key in _lsh_keys(sig):
+            self.buckets.setdefault(key, []).append(idx)
+        return idx
+
+    def similar(self, sig):
+        """Индексы сигнатур, похожих на sig сильнее NEAR_DUPLICATE_THRESHOLD."""
+        candidates = {idx for key in _lsh_keys(sig) for idx in self.buckets.get(key, [])}
+        return [idx for idx in candidates
+                if signature_similarity(sig, self.signatures[idx]) >= NEAR_DUPLICATE_THRESHOLD]
+
+def _encode_signature(sig):
+    return base64.b64encode(struct.pack(f"<{len(sig)}I", *sig)).decode()
+
+def _decode_signature(encoded):
+    raw = base64.b64decode(encoded)
+    return list(struct.unpack(f"<{len(raw) // 4}I", raw))
+
+def load_posted_stories():
+    """Сигнатуры сюжетов, опубликованных за последние POSTED_STORIES_TTL_HOURS (stories.json)."""
+    oldest = time.time() - POSTED_STORIES_TTL_HOURS * 3600
+    return [_decode_signature(s["sig"]) for s in STATE.get("stories.json", []) if s["time"] > oldest]
+
+def remember_posted_story(item):
+    """Запоминает сигнатуру опубликованного сюжета (запишется в Gist при STATE.commit())."""
+    if not item.get("signature"):
+        return
+    entry = {"time": int(time.time()), "sig": _encode_signature(item["signature"])}
+    oldest = time.time() - POSTED_STORIES_TTL_HOURS * 3600
+    STATE.update("stories.json", lambda old: [s for s in old if s["time"] > oldest] + [entry], [])
+
+def pick_new_stories(news):
+    """
+    Группирует свежие новости в сюжеты (одно событие у RIA, TASS и Lenta под разными заголовками),
+    отбрасывает сюжеты, похожие на недавно опубликованные, и оставляет по одной новости
+    (с наибольшим score) на сюжет. Порядок — по score.
+    """
+    posted = StoryIndex()
+    for sig in load_posted_stories():
+        posted.add(sig)
+
+    index = StoryIndex()
+    parent = list(range(len(news)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, item in enumerate(news):
+        item["signature"] = story_signature(item["title"], item["summary"])
+        if item["signature"] is None:
+            index.add([])  # держим индексы index и news совпадающими
+            continue
+        for j in index.similar(item["signature"]):
+            parent[find(j)] = find(i)
+        index.add(item["signature"])
+
+    clusters = {}
+    for i, item in enumerate(news):
+        clusters.setdefault(find(i), []).append(item)
+
+    picked = []
+    for members in clusters.values():
+        if any(m["signature"] and posted.similar(m["signature"]) for m in members):
+            print(f"♻️ Сюжет уже был: {members[0]['title']} (+{len(members) - 1})")
+            METRICS.incr("stories_skipped_total", len(members), reason="already_posted")
+            continue
+        METRICS.incr("stories_skipped_total", len(members) - 1, reason="near_duplicate")
+        best = max(members, key=lambda m: m["score"])
+        if len(members) > 1:
+            print(f"🧩 {len(members)} похожих новостей, беру: {best['title']}")
+        picked.append(best)
+
+    picked.sort(key=lambda item: item["score"], reverse=True)
+    return picked
+
 # === HISTORY MANAGEMENT ===
-def load_history():
+def history_file(persona=DEFAULT_PERSONA):
+    """У каждого персонажа своя история: history.json — у Витька (как раньше), history_<имя>.json — у остальных."""
+    return "history.json" if persona == DEFAULT_PERSONA else f"history_{persona}.json"
+
+def load_history(persona=DEFAULT_PERSONA):
     """
-    Загружает историю предыдущих сгенерированных текстов из Gist.
+    Возвращает историю предыдущих сгенерированных текстов персонажа из снимка Gist.
     Возвращает список строк (последние N текстов).
     """
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    headers = {"Authorization": f"token {GIST_TOKEN}"}
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            files = resp.json().get("files", {})
-            if "history.json" in files:
-                content = files["history.json"].get("content", "[]")
-                history_list = json.loads(content)
-                # Возвращаем список строк (текстов)
-                return history_list
-        return []  # Если файла нет или ошибка — возвращаем пустой список
-    except Exception as e:
-        print(f"⚠️ Ошибка загрузки history.json из Gist: {e}")
-        return []
+    return STATE.get(history_file(persona), [])
 
-def save_history(new_text):
+def save_history(new_text, topic="", persona=DEFAULT_PERSONA):
     """
-    Добавляет новый сгенерированный текст в историю и сохраняет её в Gist.
+    Добавляет новый сгенерированный текст в историю персонажа (запишется в Gist при STATE.commit()).
     new_text: строка — новый сгенерированный пост.
+    topic: заголовок новости — сразу кладётся в краткую выжимку поста.
     """
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    headers = {"Authorization": f"token {GIST_TOKEN}"}
-
-    # Загрузить текущую историю
-    current_history = load_history()
+    STATE.update(history_file(persona), lambda history: _append_limited(history, new_text), [])
+    _save_digests({_history_key(new_text): make_history_digest(new_text, topic)})
 
-    # Добавить новый текст в начало списка (или в конец — как удобнее)
-    current_history.append(new_text)
+# === PROMPT ASSEMBLY ===
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "1200"))  # токенов на историю в промпте
+HISTORY_FULL_SHARE = 0.7  # доля бюджета под посты целиком, остаток — под выжимки более ранних
+HISTORY_SCENE_CHARS = 120  # длина описания сцены в краткой выжимке
 
-    # Ограничить размер истории (например, последние 10 записей)
-    max_history_length = 10
-    if len(current_history) > max_history_length:
-        current_history = current_history[-max_history_length:]  # Оставить только последние N
+def estimate_tokens(text):
+    """
+    Грубая локальная оценка числа токенов (BPE-токенизаторы вроде Qwen режут русское слово
+    примерно на куски по 3–4 буквы, английское — по 5–6, знаки препинания — отдельные токены).
+    """
+    tokens = 0
+    for word in re.findall(r"[^\W\d_]+|\d+|[^\w\s]", text):
+        if word.isascii() and word.isalpha():
+            tokens += 1 + len(word) // 6
+        elif word.isalpha():
+            tokens += 1 + len(word) // 4
+        elif word.isdigit():
+            tokens += 1 + len(word) // 3
+        else:
+            tokens += 1
+    return tokens
 
-    # Подготовить payload для обновления
-    payload = {
-        "files": {
-            "history.json": {
-                "content": json.dumps(current_history, ensure_ascii=False, indent=2)
-            }
-        }
-    }
+def _history_key(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
 
-    try:
-        resp = requests.patch(url, headers=headers, json=payload, timeout=10)
-        if resp.status_code == 200:
-            print("✅ history.json обновлён в Gist")
+def make_history_digest(text, topic=""):
+    """
+    Краткая выжимка поста: где происходит сцена (первое предложение) и о чём новость.
+    Если заголовок неизвестен (старые записи), тема — совпавшие ключевые слова.
+    """
+    first_sentence = re.split(r"(?<=[.!?…])\s+|\n+", text.strip(), maxsplit=1)[0]
+    scene = first_sentence[:HISTORY_SCENE_CHARS].rstrip()
+    if len(first_sentence) > HISTORY_SCENE_CHARS:
+        scene += "…"
+    if not topic:
+        topic = ", ".join(KEYWORD_MATCHER.match(text)[0][:5]) or "без темы"
+    return f"{scene} (новость: {topic})"
+
+def _save_digests(new_digests):
+    # Выжимки храним только для постов, которые ещё есть в истории
+    def merge(digests):
+        keys = {_history_key(text) for persona in PERSONAS for text in load_history(persona)}
+        return {key: value for key, value in {**digests, **new_digests}.items() if key in keys}
+    STATE.update("history_digests.json", merge, {})
+
+def build_history_context(history, budget=None):
+    """
+    Собирает блок истории для промпта в пределах budget токенов:
+    последние посты целиком, пока помещаются, более ранние — краткими выжимками
+    (кэшируются в history_digests.json, чтобы не пересчитывать каждый запуск).
+    """
+    if not history:
+        return "Пока нет обсужденных тем."
+    budget = HISTORY_TOKEN_BUDGET if budget is None else budget
+
+    digests = STATE.get("history_digests.json", {})
+    missing = {}
+    full, short = [], []
+    used = 0
+    for text in reversed(history):  # от новых к старым
+        cost = estimate_tokens(text)
+        if not short and used + cost <= budget * HISTORY_FULL_SHARE:
+            full.append(text)
+            used += cost
+            continue
+        key = _history_key(text)
+        if key not in digests:
+            missing[key] = digests[key] = make_history_digest(text)
+        digest = f"- {digests[key]}"
+        cost = estimate_tokens(digest)
+        if used + cost > budget:
+            break
+        short.append(digest)
+        used += cost
+
+    if missing:
+        _save_digests(missing)
+
+    parts = list(reversed(full))
+    if short:
+        parts.insert(0, "Более ранние посты (кратко):\n" + "\n".join(reversed(short)))
+    print(f"🧮 История в промпте: {len(full)} постов целиком, {len(short)} выжимок, ~{used} токенов")
+    return "\n\n".join(parts)
+
+# === MODEL ROUTING ===
+# Модели по задачам в порядке предпочтения: первая — основная, остальные — запасные.
+# Переопределяются через LLM_MODELS / IMAGE_MODELS (через запятую).
+MODEL_TIERS = {
+    "llm": [
+        "Qwen/Qwen3-235B-A22B-Instruct-2507",
+        "meta-llama/Llama-3.3-70B-Instruct",
+        "Qwen/Qwen2.5-72B-Instruct",
+    ],
+    "image": [
+        "black-forest-labs/FLUX.1-dev",
+        "black-forest-labs/FLUX.1-schnell",
+        "stabilityai/stable-diffusion-xl-base-1.0",  # качество хуже, зато почти всегда доступна
+    ],
+}
+if os.environ.get("LLM_MODELS"):
+    MODEL_TIERS["llm"] = [m.strip() for m in os.environ["LLM_MODELS"].split(",") if m.strip()]
+if os.environ.get("IMAGE_MODELS"):
+    MODEL_TIERS["image"] = [m.strip() for m in os.environ["IMAGE_MODELS"].split(",") if m.strip()]
+
+# Параметры генерации картинки: steps — штатно, min_steps — ниже не опускаемся при нехватке времени
+IMAGE_MODEL_PARAMS = {
+    "black-forest-labs/FLUX.1-dev": {"steps": 40, "min_steps": 20, "guidance_scale": 7.5},
+    "black-forest-labs/FLUX.1-schnell": {"steps": 4, "min_steps": 2, "guidance_scale": 0.0},
+    "stabilityai/stable-diffusion-xl-base-1.0": {"steps": 30, "min_steps": 15, "guidance_scale": 7.5},
+}
+IMAGE_DEFAULT_PARAMS = {"steps": 30, "min_steps": 15, "guidance_scale": 7.5}
+IMAGE_SIZES = (1024, 768, 512)  # квадрат; под давлением дедлайна спускаемся к меньшему
+
+MODELS_FILE = "models.json"
+MODEL_STATS_ALPHA = 0.3  # вес нового замера в скользящих средних
+MODEL_MAX_ERROR_RATE = 0.5  # выше — модель деградировала и уходит на паузу
+MODEL_DEGRADED_COOLDOWN = 30 * 60  # секунд
+MODEL_RATE_LIMIT_COOLDOWN = 10 * 60  # секунд после 429 без Retry-After
+MODEL_DEADLINE_SAFETY = 0.8  # модель берём, если её ожидаемое время ≤ этой доли остатка бюджета
+# error_rate модели после паузы: наименьшее значение, при котором одна новая ошибка
+# ((1 - alpha) * x + alpha) снова дотягивает до MODEL_MAX_ERROR_RATE. Округлено вверх до точности models.json
+MODEL_PROBATION_ERROR_RATE = math.ceil(
+    (MODEL_MAX_ERROR_RATE - MODEL_STATS_ALPHA) / (1 - MODEL_STATS_ALPHA) * 1000) / 1000
+
+def load_model_stats():
+    """
+    Скользящая статистика моделей из models.json:
+    {модель: {"calls", "error_rate", "unit_s", "cooldown_until"}}, unit_s — секунд на единицу работы
+    (вызов LLM или шаг генерации 1024×1024).
+    """
+    return STATE.get(MODELS_FILE, {})
+
+def _update_model_stats(stats, model, seconds, units, failed, cooldown, now):
+    entry = dict(stats.get(model, {}))
+    alpha = MODEL_STATS_ALPHA
+    entry["calls"] = entry.get("calls", 0) + 1
+    entry["error_rate"] = round((1 - alpha) * entry.get("error_rate", 0.0) + alpha * failed, 3)
+    if not failed:
+        unit_s = seconds / units
+        entry["unit_s"] = round(unit_s if "unit_s" not in entry else (1 - alpha) * entry["unit_s"] + alpha * unit_s, 4)
+    if cooldown:
+        entry["cooldown_until"] = now + cooldown
+    elif failed and entry["error_rate"] >= MODEL_MAX_ERROR_RATE:
+        entry["cooldown_until"] = now + MODEL_DEGRADED_COOLDOWN
+        # После паузы у модели одна пробная попытка: новая ошибка снова отправит её на паузу
+        entry["error_rate"] = MODEL_PROBATION_ERROR_RATE
+    return {**stats, model: entry}
+
+def record_model_call(task, model, seconds, units=1.0, error=None):
+    """Записывает исход вызова модели в models.json (в Gist уйдёт при STATE.commit())."""
+    cooldown = 0
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        cooldown = _retry_after(response) or MODEL_RATE_LIMIT_COOLDOWN
+    now = time.time()
+    STATE.update(MODELS_FILE, lambda stats: _update_model_stats(stats, model, seconds, units, error is not None,
+                                                                cooldown, now), {})
+    METRICS.incr("model_calls_total", task=task, model=model, result="error" if error else "ok")
+    if error is None:
+        METRICS.gauge("model_latency_seconds", round(seconds, 3), task=task, model=model)
+
+def _default_plan(model, unit_s, budget, work=1.0):
+    """План вызова без параметров: успевает ли модель по средней задержке."""
+    return {}, work, unit_s is None or unit_s * work <= budget
+
+def image_plan(model, unit_s, budget):
+    """
+    Параметры картинки под остаток бюджета: сначала меньше шагов (до min_steps),
+    потом меньше разрешение. Если не помещается ничего — самый дешёвый вариант с fits=False.
+    """
+    params = IMAGE_MODEL_PARAMS.get(model, IMAGE_DEFAULT_PARAMS)
+    steps, size = params["steps"], IMAGE_SIZES[0]
+    fits = unit_s is None
+    if not fits:
+        for size in IMAGE_SIZES:
+            scale = (size / IMAGE_SIZES[0]) ** 2
+            steps = min(params["steps"], int(budget / (unit_s * scale)))
+            if steps >= params["min_steps"]:
+                fits = True
+                break
         else:
-            print(f"❌ Ошибка сохранения history.json: {resp.status_code}")
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения history.json: {e}")
+            steps = params["min_steps"]
+    if fits and (steps, size) != (params["steps"], IMAGE_SIZES[0]):
+        print(f"⏳ {model}: мало времени — {steps} шагов, {size}×{size}")
+        METRICS.incr("image_downscaled_total", model=model)
+    kwargs = {"num_inference_steps": steps, "guidance_scale": params["guidance_scale"], "height": size, "width": size}
+    return kwargs, steps * (size / IMAGE_SIZES[0]) ** 2, fits
+
+def route_model(task, call, plan=None):
+    """
+    Вызывает call(model, **параметры) по моделям MODEL_TIERS[task] до первого успеха.
+    Модели на паузе (429, высокая доля ошибок) ставятся в конец очереди и пробуются, только если остальные
+    не ответили. Модели, которые по скользящей средней не успевают до дедлайна этапа, пропускаются
+    (последнюю пробуем всё равно: медленный ответ лучше заглушки).
+    plan(model, unit_s, budget) -> (параметры, объём работы, успевает ли) — по умолчанию _default_plan.
+    Возвращает (модель, результат); если не ответил никто — пробрасывает последнюю ошибку.
+    """
+    plan = plan or _default_plan
+    stats = load_model_stats()
+    now = time.time()
+    ready = [m for m in MODEL_TIERS[task] if stats.get(m, {}).get("cooldown_until", 0) <= now]
+    paused = [m for m in MODEL_TIERS[task] if m not in ready]
+    METRICS.gauge("models_paused", len(paused), task=task)
+    candidates = ready + paused
+    if not candidates:
+        raise RuntimeError(f"Не настроены модели для {task}")
+    deadline = current_deadline()
+    error = None
+    for i, model in enumerate(candidates):
+        entry = stats.get(model, {})
+        kwargs, units, fits = plan(model, entry.get("unit_s"), deadline.remaining() * MODEL_DEADLINE_SAFETY)
+        last = i == len(candidates) - 1
+        if not fits and not last:
+            print(f"⏭️ {task}: {model} не успеет (~{entry['unit_s'] * units:.0f} с) — пропускаю")
+            METRICS.incr("model_calls_total", task=task, model=model, result="slow")
+            continue
+        if model in paused:
+            print(f"🔀 {task}: остальные не ответили — пробую {model}, хотя она на паузе")
+        elif model != MODEL_TIERS[task][0]:
+            print(f"🔀 {task}: использую {model}")
+        started = time.monotonic()
+        try:
+            result = call(model, **kwargs)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            record_model_call(task, model, time.monotonic() - started, units, error=e)
+            print(f"⚠️ {task}: {model} не ответила: {e}")
+            error = e
+            continue
+        record_model_call(task, model, time.monotonic() - started, units)
+        return model, result
+    raise error
+
+# === LLM GENERATION ===
+# Модели — в MODEL_TIERS["llm"], выбирает route_model
+LLM_STREAM = True  # потоковая генерация: обрываем ответ, как только дописан промпт для картинки
+IMAGE_PROMPT_MARKER = "PROMPT FOR IMAGE:"
+
+
+class PostStreamParser:
+    """
+    Инкрементальный разбор ответа LLM: текст поста идёт до IMAGE_PROMPT_MARKER, промпт для картинки — после.
+    feed() возвращает True, когда промпт для картинки закончен (конец его строки) — дальше токены
+    не нужны и генерацию можно обрывать. Промпт вида «[объект], [действие], [окружение]» содержит
+    несколько «]», поэтому по скобкам конец не ищем; без перевода строки промпт идёт до конца ответа.
+    """
 
-def generate_post_with_llm(title, summary):
-    """Генерация поста через Hugging Face Inference API с историей и разделением вывода."""
+    def __init__(self):
+        self.buffer = ""
+        self.marker_pos = -1
+        self.prompt_end = None  # конец промпта для картинки в buffer, когда он завершён
+
+    def feed(self, delta):
+        if self.prompt_end is not None:
+            return True
+        search_from = max(0, len(self.buffer) - len(IMAGE_PROMPT_MARKER))
+        self.buffer += delta
+        if self.marker_pos < 0:
+            self.marker_pos = self.buffer.find(IMAGE_PROMPT_MARKER, search_from)
+            if self.marker_pos < 0:
+                return False
+
+        start = self.marker_pos + len(IMAGE_PROMPT_MARKER)
+        prompt = self.buffer[start:]
+        stripped = prompt.lstrip()
+        if not stripped:
+            return False
+        end = stripped.find("\n")
+        if end >= 0:
+            self.prompt_end = start + len(prompt) - len(stripped) + end
+        return self.prompt_end is not None
+
+    def result(self):
+        """(текст поста, промпт для картинки)."""
+        if self.marker_pos < 0:
+            return self.buffer.strip(), "Bird" # Заглушка
+        text = self.buffer[:self.marker_pos].strip()
+        img_prompt = self.buffer[self.marker_pos + len(IMAGE_PROMPT_MARKER):self.prompt_end]
+        return text, img_prompt.strip().strip("[]\"' ") or "Bird"
+
+
+def _stream_post(model, messages):
+    """
+    Потоковая генерация поста: токены разбираются по мере прихода,
+    поток закрывается сразу после промпта для картинки. Логирует время до первого токена и скорость.
+    Повторяется только установка потока; оборвавшаяся посреди генерация и истёкший бюджет — ошибка.
+    """
+    parser = PostStreamParser()
+    deadline = current_deadline()
+    started = time.monotonic()
+    first_token_at = None
+    tokens = 0
+    stream = with_retries(lambda timeout: inference_client(timeout=timeout).chat_completion(
+        model=model,
+        messages=messages,
+        max_tokens=5000,
+        temperature=0.7,
+        stream=True,
+    ), model, deadline)
+    try:
+        for chunk in stream:
+            deadline.check("LLM")
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            tokens += 1  # TGI отдаёт по одному токену в чанке
+            if parser.feed(delta):
+                print("✂️ Промпт для картинки получен — обрываю генерацию")
+                break
+    finally:
+        # Закрываем HTTP-поток, чтобы сервер перестал генерировать
+        if hasattr(stream, "close"):
+            stream.close()
+
+    finished = time.monotonic()
+    METRICS.incr("llm_output_tokens_total", tokens)
+    if first_token_at is not None:
+        METRICS.gauge("llm_time_to_first_token_seconds", round(first_token_at - started, 3))
+        METRICS.gauge("llm_tokens_per_second", round(tokens / max(finished - first_token_at, 1e-6), 1))
+        generation_time = finished - first_token_at
+        print(f"⏱️ LLM: первый токен через {first_token_at - started:.1f} с, "
+              f"{tokens} токенов за {generation_time:.1f} с ({tokens / max(generation_time, 1e-6):.1f} ток/с)")
+    return parser.result()
+
+
+def generate_post_with_llm(title, summary, persona=DEFAULT_PERSONA):
+    """
+    Генерация поста через Hugging Face Inference API с историей и разделением вывода.
+    persona — ключ PERSONAS: промпты, заглушка и история у каждого персонажа свои.
+    Возвращает (текст, промпт для картинки); пустой промпт — значит, вернулась заглушка.
+    В историю пост не пишется: это делает process_story, когда пост дошёл до канала.
+    """
+    prompts = PERSONAS[persona]
+    fallback_text = prompts["fallback"].format(title=title)
     # 1. Загрузить историю (предыдущие сгенерированные тексты)
-    history = load_history()
+    history = load_history(persona)
 
-    # Преобразуем список прошлых текстов в одну строку, разделённую, например, двойным переводом строки
-    history_str = "\n\n".join(history) if history else "Пока нет обсужденных тем."
+    # Свежие посты целиком, ранние — краткими выжимками, в пределах HISTORY_TOKEN_BUDGET
+    history_str = build_history_context(history)
 
     # 2. Подставить историю и новость в пользовательский промпт
-    user_prompt = USER_PROMPT_HERE.format(
+    user_prompt = prompts["user_prompt"].format(
         history_str=history_str,
         title=title,
         summary=summary
@@ -277,62 +1631,184 @@ def generate_post_with_llm(title, summary):
 
     # 3. Подготовить список сообщений для chat_completion
     messages = [
-        {"role": "system", "content": SYSTEM_PROMPT_HERE},
+        {"role": "system", "content": prompts["system_prompt"]},
         {"role": "user", "content": user_prompt}
     ]
 
-    print("📝 Отправляю промпт в Qwen3-235B (v2)...")
+    print(f"📝 Отправляю промпт в LLM (v2, {persona})...")
+    METRICS.incr("llm_prompt_tokens_estimate_total",
+                 estimate_tokens(prompts["system_prompt"]) + estimate_tokens(user_prompt))
 
     hf_token = os.environ.get("HF_TOKEN")
     if not hf_token:
         print("❌ HF_TOKEN не найден!")
-        fallback_text = f"Батенька опять в новостях: {title}. А мне-то чё? У меня гараж есть. За Родину-мать не стыдно рвать! 🇷🇺"
         return fallback_text, ""
 
-    client = InferenceClient(token=hf_token)
-
     try:
-        response = client.chat_completion(
-            model="Qwen/Qwen3-235B-A22B-Instruct-2507",
-            messages=messages, # <-- Передаём список сообщений
-            max_tokens=5000,
-            temperature=0.7
-        )
-        full_output = response.choices[0].message.content.strip()
-        print("✅ LLM v2 ответил успешно")
-
-        # 4. Разделить вывод на текст поста и промпт для картинки
-        if "PROMPT FOR IMAGE:" in full_output:
-            text_part, img_prompt_raw = full_output.split("PROMPT FOR IMAGE:", 1)
-            text = text_part.strip()
-            img_prompt = img_prompt_raw.strip().strip("[]\"' ")
+        # 4. Получить ответ и разделить его на текст поста и промпт для картинки
+        # Модель выбирает route_model: при ошибке или нехватке времени — следующая по MODEL_TIERS
+        if LLM_STREAM:
+            _, (text, img_prompt) = route_model("llm", lambda model: _stream_post(model, messages))
         else:
-            text = full_output
-            img_prompt = "Bird" # Заглушка
-
-        # 5. Сохранить только что сгенерированный ТЕКСТ (без промпта для картинки) в историю
-        save_history(text)
+            _, response = route_model("llm", lambda model: with_retries(
+                lambda timeout: inference_client(timeout=timeout).chat_completion(
+                    model=model,
+                    messages=messages, # <-- Передаём список сообщений
+                    max_tokens=5000,
+                    temperature=0.7
+                ), model))
+            parser = PostStreamParser()
+            parser.feed(response.choices[0].message.content)
+            text, img_prompt = parser.result()
+        print("✅ LLM v2 ответил успешно")
 
-        # 6. Вернуть кортеж (text, img_prompt)
+        # 5. Вернуть кортеж (text, img_prompt)
         return text, img_prompt
 
     except Exception as e:
         print(f"❌ Ошибка в LLM v2: {e}")
         # Возвращаем ТОЛЬКО текст, БЕЗ промпта для картинки
-        fallback_text = f"Батенька опять в новостях: {title}. А мне-то чё? У меня гараж есть. За Родину-мать не стыдно рвать! 🇷🇺"
         return fallback_text, "" # Возвращаем кортеж
 
 # === HF IMAGE GENERATION ===
+TELEGRAM_PHOTO_MAX_SIDE = 1280  # Telegram всё равно ужимает фото до 1280 px по большей стороне
+TELEGRAM_PHOTO_MAX_BYTES = 2 * 1024 * 1024  # с запасом до лимита sendPhoto в 10 МБ
+IMAGE_JPEG_QUALITY = 87
+IMAGE_JPEG_MIN_QUALITY = 60
+
+def encode_for_telegram(image_obj):
+    """
+    Готовит картинку к отправке в Telegram: JPEG не больше TELEGRAM_PHOTO_MAX_SIDE
+    и TELEGRAM_PHOTO_MAX_BYTES. Байты, которые уже подходят, отдаются как есть, без перекодирования.
+    image_obj: bytes или PIL.Image. Возвращает bytes.
+    """
+    from PIL import Image
+
+    if isinstance(image_obj, bytes):
+        image = Image.open(io.BytesIO(image_obj))
+        if (image.format == "JPEG" and max(image.size) <= TELEGRAM_PHOTO_MAX_SIDE
+                and len(image_obj) <= TELEGRAM_PHOTO_MAX_BYTES):
+            return image_obj
+    else:
+        image = image_obj
+
+    image = image.convert("RGB")
+    if max(image.size) > TELEGRAM_PHOTO_MAX_SIDE:
+        image.thumbnail((TELEGRAM_PHOTO_MAX_SIDE, TELEGRAM_PHOTO_MAX_SIDE), Image.LANCZOS)
+
+    quality = IMAGE_JPEG_QUALITY
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+        if buffer.tell() <= TELEGRAM_PHOTO_MAX_BYTES or quality <= IMAGE_JPEG_MIN_QUALITY:
+            return buffer.getvalue()
+        quality -= 10
+
+# === IMAGE PROMPT SIMILARITY ===
+IMAGE_PROMPT_SIMILARITY_THRESHOLD = 0.5  # сходство Жаккара, начиная с которого сцена считается повтором
+_PROMPT_STOPWORDS = {
+    "the", "and", "with", "for", "from", "into", "onto", "near", "his", "her", "their", "its",
+    "are", "is", "while", "who", "which", "that", "this", "some", "one", "two", "other",
+}
+# Запасные обстановки из лора Витька для детерминированной переделки сцены
+IMAGE_SCENE_VARIANTS = [
+    "at a frozen fishing hole on a tundra river",
+    "in a steamy village banya changing room",
+    "in a queue at a tiny rural post office",
+    "next to a broken-down UAZ van on a snowy road",
+    "on a muddy vegetable plot behind a wooden house",
+    "at a rural bus stop during a snowstorm",
+    "in the hallway of a shabby village house of culture",
+    "in a cramped kitchen of a Khrushchev-era apartment",
+]
+
+def _prompt_tokens(prompt):
+    return {w for w in re.findall(r"[a-z]+", prompt.lower()) if len(w) > 2 and w not in _PROMPT_STOPWORDS}
+
+def prompt_similarity(prompt_a, prompt_b):
+    """Сходство Жаккара двух промптов по значимым словам."""
+    a, b = _prompt_tokens(prompt_a), _prompt_tokens(prompt_b)
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+def _max_similarity(prompt, history):
+    return max((prompt_similarity(prompt, old) for old in history), default=0.0)
+
+def _regenerate_image_prompt(prompt, history):
+    """Дешёвая перегенерация только промпта (без поста) через LLM. Возвращает строку или None."""
+    hf_token = os.environ.get("HF_TOKEN")
+    if not hf_token:
+        return None
+    previous = "\n".join(f"- {old}" for old in history[-5:])
+    messages = [
+        {"role": "system", "content": "You write short English prompts for an image generator. Answer with the prompt only."},
+        {"role": "user", "content": (
+            f"Rewrite this scene so that the location, characters and composition differ from the previous scenes, "
+            f"keeping its meaning. No portraits, no text, no brands, no political symbols.\n\n"
+            f"Scene: {prompt}\n\nPrevious scenes:\n{previous}"
+        )},
+    ]
+    try:
+        # Короткий ответ — примерно пятая часть работы по сравнению с постом (для оценки задержки в route_model)
+        _, response = route_model("llm", lambda model: with_retries(
+            lambda timeout: inference_client(timeout=timeout).chat_completion(
+                model=model,
+                messages=messages,
+                max_tokens=200,
+                temperature=0.9,
+            ), model), plan=functools.partial(_default_plan, work=0.2))
+        return response.choices[0].message.content.strip().strip("[]\"' ") or None
+    except Exception as e:
+        print(f"⚠️ Не удалось перегенерировать промпт для картинки: {e}")
+        return None
+
+def _rewrite_image_prompt(prompt, history):
+    """
+    Детерминированная переделка: переносим сцену в обстановку, меньше всего похожую на историю.
+    Промпт по SYSTEM_PROMPT_HERE строится как «[объект], [действие], [окружение], ...» —
+    заменяем третью часть, а если частей меньше, дописываем обстановку в конец.
+    """
+    variant = min(IMAGE_SCENE_VARIANTS, key=lambda v: (_max_similarity(v, history), v))
+    parts = [part.strip() for part in prompt.rstrip(". ").split(",")]
+    if len(parts) >= 3:
+        parts[2] = variant
+    else:
+        parts.append(variant)
+    return ", ".join(parts)
+
+def ensure_fresh_image_prompt(prompt):
+    """
+    Проверяет промпт для картинки против истории image_prompt.json до дорогого вызова FLUX.
+    Если сцена повторяет одну из прошлых, сначала просим LLM переписать только промпт,
+    а если и это не помогло — детерминированно меняем обстановку.
+    """
+    history = load_image_prompts_history()
+    similarity = _max_similarity(prompt, history)
+    if similarity < IMAGE_PROMPT_SIMILARITY_THRESHOLD:
+        return prompt
+
+    print(f"♻️ Промпт для картинки похож на прошлый ({similarity:.2f}) — переписываю")
+    regenerated = _regenerate_image_prompt(prompt, history)
+    if regenerated and _max_similarity(regenerated, history) < IMAGE_PROMPT_SIMILARITY_THRESHOLD:
+        METRICS.incr("image_prompt_rewrites_total", method="llm")
+        return regenerated
+    METRICS.incr("image_prompt_rewrites_total", method="deterministic")
+    return _rewrite_image_prompt(prompt, history)
+
 def generate_image_with_hf(prompt):
     """
     Генерация изображения через Hugging Face Inference API (синхронно).
+    Возвращает (JPEG в виде bytes без временных файлов или None, использованный промпт).
     Использует HF_TOKEN из переменных окружения.
-    Учитывает историю предыдущих промптов через negative_prompt для избежания повторов.
+    Перед генерацией промпт сверяется с историей (ensure_fresh_image_prompt), чтобы не платить за повтор сцены.
+    В image_prompt.json промпт пишет process_story, когда пост дошёл до канала.
     """
     hf_token = os.environ.get("HF_TOKEN")
     if not hf_token:
         print("❌ HF_TOKEN не найден в переменных окружения")
-        return None
+        return None, prompt
+
+    # 0. Отсеять повтор сцены до дорогого вызова модели
+    prompt = ensure_fresh_image_prompt(prompt)
 
     # 1. Подготовить стилевые параметры
     style_part = "Photorealistic, highly detailed, 8k high definition"
@@ -345,120 +1821,408 @@ def generate_image_with_hf(prompt):
     # Включаем "repeated scene, same as before" как основной способ избежать повторов
     negative_prompt = "text, deformed, portrait, low quality, low resolution, out of focus"
 
-    client = InferenceClient(
-        # model="stabilityai/stable-diffusion-xl-base-1.0", говно качество
-        # model="stabilityai/stable-diffusion-3.5-large", лимиты
-        model = "black-forest-labs/FLUX.1-dev",
-        token=hf_token,
-    )
+    def text_to_image(model, **params):
+        # Шаги, guidance и размер — из IMAGE_MODEL_PARAMS, урезанные image_plan под остаток бюджета
+        return with_retries(lambda timeout: inference_client(model=model, timeout=timeout).text_to_image(
+            prompt=full_prompt,
+            negative_prompt=negative_prompt,
+            **params,
+        ), model)
 
     try:
-        print("🎨 Генерирую изображение через HF Inference API (SDXL)...")
+        print("🎨 Генерирую изображение через HF Inference API...")
         print(f"   -> Full prompt: {full_prompt[:5000]}...") # <-- Лог для отладки (первые 5000 символов, или меньше)
-        image_obj = client.text_to_image(
-            prompt=full_prompt,
-            negative_prompt=negative_prompt,
-            # ДОБАВЛЕННЫЕ ПАРАМЕТРЫ ДЛЯ ЛУЧШЕГО КАЧЕСТВА:
-            num_inference_steps=40,      # Больше шагов = лучше детализация (по умолчанию 20-25)
-            guidance_scale=7.5,          # Сильнее следование промпту (по умолчанию 7.0)
-            height=1024,                 # Оптимальный размер для FLUX
-            width=1024,                  # Квадрат лучше для Telegram постов
-        )
-
-        # Обработка возвращаемого объекта (может быть bytes или PIL.Image)
-        img_path = "/tmp/vitok_post_hf.jpg"
+        model, image_obj = route_model("image", text_to_image, plan=image_plan)
+
+        # Обработка возвращаемого объекта (может быть bytes или PIL.Image) — всё в памяти, без файлов
         if isinstance(image_obj, bytes):
             print("✅ Получены байты изображения")
-            with open(img_path, "wb") as f:
-                f.write(image_obj)
         elif hasattr(image_obj, 'save'):
             print("✅ Получен PIL Image объект")
-            image_obj.save(img_path, format="JPEG")
         else:
             print(f"❌ Неожиданный тип возвращаемого объекта: {type(image_obj)}")
-            return None
-
-        print(f"✅ Изображение HF сохранено: {img_path}")
+            return None, prompt
 
-        # 4. Сохранить ТЕКУЩИЙ чистый промпт (не full_prompt, а исходный от LLM) в историю
-        save_image_prompt_to_history(prompt)
+        image_bytes = encode_for_telegram(image_obj)
+        METRICS.incr("image_generations_total")
+        METRICS.incr("image_bytes_total", len(image_bytes))
+        print(f"✅ Изображение HF готово ({model}): {len(image_bytes) / 1024:.0f} КБ JPEG")
 
-        return img_path
+        # 4. Вернуть картинку и ТЕКУЩИЙ чистый промпт (не full_prompt, а исходный от LLM) — для истории
+        return image_bytes, prompt
 
     except Exception as e:
         print(f"❌ Ошибка в HF Image Gen: {e}")
-        return None
+        return None, prompt
 
 # === TELEGRAM ===
-def send_to_telegram(text, image_path=None):
-    base_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+TELEGRAM_TIMEOUT = (5, 30)  # (connect, read) секунд; загрузка фото — до пары мегабайт
+TELEGRAM_SEND_WORKERS = 4
+TELEGRAM_CHAT_INTERVAL = 3.0  # секунд между сообщениями в один чат: лимит Bot API — 20 в минуту на группу/канал
+TELEGRAM_GLOBAL_INTERVAL = 1 / 30  # и не больше 30 сообщений в секунду на бота
+TELEGRAM_FILE_ID_CACHE = 64  # сколько последних загруженных картинок помним по file_id
 
-    if image_path:
-        # Отправляем фото с подписью (caption = текст)
-        try:
-            with open(image_path, "rb") as img:
-                files = {"photo": img}
-                data = {
-                    "chat_id": CHANNEL,
-                    "caption": text[:1024],  # <-- Текст как подпись к фото (макс. 1024 символа)
-                    "parse_mode": "HTML"
-                }
-                resp_img = requests.post(f"{base_url}/sendPhoto", files=files, data=data)
-        except Exception as e:
-            print(f"⚠️ Не удалось отправить картинку: {e}")
-    else:
-        # Если картинки нет — отправляем только текст
-        data = {
-            "chat_id": CHANNEL,
-            "text": text[:4096],
-            "parse_mode": "HTML"
-        }
-        resp = requests.post(f"{base_url}/sendMessage", data=data)
+def telegram_api(method, data, files=None, deadline=None):
+    """
+    Вызов Bot API. 429 повторяется через retry_after из ответа; 5xx и обрывы — нет:
+    sendPhoto/sendMessage неидемпотентны, и повтор может задвоить пост.
+    Возвращает result из ответа или None при ошибке Telegram.
+    """
+    resp = http_request("POST", f"{TELEGRAM_API_URL}/bot{require_env('TELEGRAM_BOT_TOKEN')}/{method}",
+                        data=data, files=files, timeout=TELEGRAM_TIMEOUT, deadline=deadline)
+    METRICS.incr("telegram_messages_total", method=method, result="ok" if resp.ok else "error")
+    if not resp.ok:
+        print(f"❌ Telegram {method}: {resp.status_code} {resp.text[:200]}")
+        return None
+    return resp.json().get("result")
 
 
+class TelegramSender:
+    """
+    Общий отправитель для всех каналов: пул потоков поверх общей HTTP-сессии,
+    очередь по частоте на каждый чат и на бота в целом, повторное использование фото по file_id —
+    одна и та же картинка загружается один раз, в остальные каналы уходит ссылка на неё.
+    """
 
+    def __init__(self, workers=TELEGRAM_SEND_WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self._pool = None
+        self.next_chat_slot = {}  # chat_id -> monotonic-время, раньше которого в чат не пишем
+        self.next_global_slot = 0.0
+        self.file_ids = {}  # хэш картинки -> file_id первой загрузки
+        self.upload_locks = {}  # хэш картинки -> Lock: параллельные отправки ждут первую загрузку
+
+    def pool(self):
+        with self.lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="telegram")
+            return self._pool
+
+    def _wait_turn(self, chat_id, deadline):
+        """Бронирует ближайший слот для чата с учётом обоих лимитов и ждёт его."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_chat_slot.get(chat_id, 0.0), self.next_global_slot)
+            self.next_chat_slot[chat_id] = slot + TELEGRAM_CHAT_INTERVAL
+            self.next_global_slot = slot + TELEGRAM_GLOBAL_INTERVAL
+        if slot > now:
+            time.sleep(min(slot - now, deadline.remaining()))
+            deadline.check(f"очередь Telegram {chat_id}")
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > TELEGRAM_FILE_ID_CACHE:
+            cache.pop(next(iter(cache)))
+
+    def send(self, chat_id, text, image=None, deadline=None):
+        """Отправляет пост в chat_id и ждёт ответа. Возвращает result Bot API или None."""
+        deadline = deadline or current_deadline()
+        if not image:
+            self._wait_turn(chat_id, deadline)
+            return telegram_api("sendMessage", {"chat_id": chat_id, "text": text[:4096], "parse_mode": "HTML"},
+                                deadline=deadline)
+
+        # Текст как подпись к фото (макс. 1024 символа)
+        data = {"chat_id": chat_id, "caption": text[:1024], "parse_mode": "HTML"}
+        key = hashlib.blake2b(image, digest_size=16).digest()
+        with self.lock:
+            upload_lock = self.upload_locks.get(key)
+            if upload_lock is None:
+                upload_lock = threading.Lock()
+                self._remember(self.upload_locks, key, upload_lock)
+        with upload_lock:
+            file_id = self.file_ids.get(key)
+            if file_id is None:
+                self._wait_turn(chat_id, deadline)
+                result = telegram_api("sendPhoto", data, files={"photo": ("vitok.jpg", image, "image/jpeg")},
+                                      deadline=deadline)
+                METRICS.incr("telegram_upload_bytes_total", len(image))
+                if result and result.get("photo"):
+                    with self.lock:
+                        self._remember(self.file_ids, key, result["photo"][-1]["file_id"])
+                return result
+        METRICS.incr("telegram_photo_reused_total")
+        self._wait_turn(chat_id, deadline)
+        return telegram_api("sendPhoto", {**data, "photo": file_id}, deadline=deadline)
+
+
+TELEGRAM_SENDER = TelegramSender()
+
+def send_to_telegram(text, image=None, chat_id=None):
+    """
+    Публикует пост в канал chat_id (по умолчанию CHANNEL) через TELEGRAM_SENDER.
+    image: JPEG в виде bytes — загружается прямо из памяти, в другие каналы уходит по file_id.
+    Возвращает result Bot API или None, если Telegram пост не принял; сетевые ошибки и дедлайн пробрасываются.
+    """
+    chat_id = chat_id or CHANNEL
+    if DRY_RUN:
+        return print_post(text, image, chat_id=chat_id)
 
-# === MAIN ===
-if __name__ == "__main__":
-    print("🔍 Загружаем уже обработанные новости из Gist...")
-    seen_titles = load_seen()
+    # С картинкой текст уходит подписью к фото, без неё — обычным сообщением
+    return TELEGRAM_SENDER.send(chat_id, text, image)
 
-    print("🔍 Ищу свежие политические новости...")
-    news = fetch_political_news(hours=1)
 
-    if not news:
-        print("😴 Нет свежих новостей за последний час.")
-        save_seen(seen_titles)
-        exit(0)
+def print_post(text, image=None, image_path=None, chat_id=None):
+    """
+    Вместо публикации печатает пост (для generate и --dry-run); картинку можно сохранить в image_path.
+    Возвращает True: для process_story напечатанный пост считается опубликованным.
+    """
+    print("─" * 40)
+    if chat_id and len(CHANNELS) > 1:
+        print(f"📣 {chat_id}")
+    print(text)
+    if image and image_path and chat_id and len(CHANNELS) > 1:
+        # Каналы печатаются параллельно из пула — у каждого свой файл: post.jpg -> post_vitok_news.jpg
+        root, ext = os.path.splitext(image_path)
+        suffix = re.sub(r"[^\w-]", "", str(chat_id))
+        image_path = f"{root}_{suffix}{ext}"
+    if image and image_path:
+        with open(image_path, "wb") as f:
+            f.write(image)
+        print(f"🖼️ Картинка сохранена: {image_path}")
+    elif image:
+        print(f"🖼️ Картинка: {len(image) / 1024:.0f} КБ JPEG")
+    print("─" * 40)
+    return True
+
+
+# === BATCH PROCESSING ===
+POSTS_PER_RUN = int(os.environ.get("POSTS_PER_RUN", "1"))  # сколько сюжетов публикуем за запуск
+BACKLOG_TTL_HOURS = 6  # сюжеты старше этого из очереди выбрасываются — новость протухла
+BACKLOG_MAX_ITEMS = 50
+BACKLOG_FIELDS = ("title", "summary", "link", "keywords", "categories", "score", "time")
+# Ограничения параллельности по этапам: LLM и FLUX дорогие, в Telegram постим по одному
+STAGE_LIMITS = {
+    "llm": threading.BoundedSemaphore(int(os.environ.get("LLM_CONCURRENCY", "2"))),
+    "image": threading.BoundedSemaphore(int(os.environ.get("IMAGE_CONCURRENCY", "1"))),
+    "telegram": threading.BoundedSemaphore(1),
+}
+
+def load_backlog():
+    """Очередь неопубликованных сюжетов из прошлых запусков (backlog.json), без протухших."""
+    oldest = time.time() - BACKLOG_TTL_HOURS * 3600
+    return [item for item in STATE.get("backlog.json", []) if item.get("time", 0) > oldest]
+
+def save_backlog(items):
+    """Сохраняет очередь (запишется в Gist при STATE.commit())."""
+    entries = [{key: item[key] for key in BACKLOG_FIELDS if key in item} for item in items[:BACKLOG_MAX_ITEMS]]
+    STATE.update("backlog.json", lambda old: entries, [])
+
+def _persona_post(item, persona):
+    """(текст, промпт) сюжета для дополнительного персонажа (в потоке пула — со своим бюджетом этапа)."""
+    with STAGE_LIMITS["llm"], stage_deadline("llm"):
+        return generate_post_with_llm(item["title"], item["summary"], persona)
+
+def publish_to_channels(publish, texts, image=None):
+    """
+    Рассылает пост во все CHANNELS параллельно через пул TELEGRAM_SENDER.
+    texts: персонаж -> текст. Ошибка одного канала не мешает остальным.
+    Возвращает список чатов, куда пост дошёл; исключение — если не дошёл ни в один
+    (тогда process_story шлёт заглушку). Ответ None от publish тоже считается ошибкой.
+    """
+    def send(channel):
+        with stage_deadline("telegram"):
+            if publish(texts[channel["persona"]], image, chat_id=channel["chat_id"]) is None:
+                raise RuntimeError("Telegram не принял пост")
+
+    futures = [(channel["chat_id"], TELEGRAM_SENDER.pool().submit(send, channel)) for channel in CHANNELS]
+    delivered, errors = [], []
+    for chat_id, future in futures:
+        try:
+            future.result()
+            delivered.append(chat_id)
+        except Exception as e:
+            print(f"⚠️ Не удалось опубликовать в {chat_id}: {e}")
+            errors.append(e)
+    if not delivered:
+        raise errors[0]
+    return delivered
 
-    item = news[0]
+def process_story(item, publish=None):
+    """
+    Полный цикл для одного сюжета: текст → картинка → публикация во все CHANNELS.
+    Каждый этап ограничен STAGE_LIMITS по параллельности и STAGE_BUDGETS по времени.
+    Картинка одна на сюжет: её промпт берётся из поста основного канала, тексты остальных
+    персонажей генерируются параллельно с картинкой.
+    publish(text, image, chat_id=...) — send_to_telegram или print_post для generate.
+    Возвращает True, если пост (или хотя бы заглушка) дошёл хотя бы в один канал: только тогда
+    сюжет запоминается опубликованным, а тексты и промпт картинки попадают в историю
+    (иначе при повторе из очереди они считались бы «уже обсуждёнными»). Иначе run_once вернёт сюжет в очередь.
+    """
+    publish = publish or send_to_telegram
+    primary = CHANNELS[0]["persona"]
+    others = sorted({channel["persona"] for channel in CHANNELS} - {primary})
     print(f"📰 Нашёл: {item['title']}")
-
-    full_output = ""
     try:
-        print("🧠 Генерирую пост через LLM (v2)...")  # <-- Уточнили лог
-        # Новая функция возвращает кортеж (text, img_prompt)
-        text, img_prompt = generate_post_with_llm(item["title"], item["summary"])  # <-- Вызов новой логики
-
-        # Разделение уже внутри функции, просто используем возвращаемые значения
-        print("🎨 Генерирую картинку...")
-        img_path = generate_image_with_hf(img_prompt)
-
-        print("📤 Постим в Telegram...")
-        send_to_telegram(text, img_path)
+        with STAGE_LIMITS["llm"], stage_deadline("llm"):
+            print("🧠 Генерирую пост через LLM (v2)...")
+            # Функция возвращает кортеж (text, img_prompt), разделение уже внутри; персонаж -> кортеж
+            posts = {primary: generate_post_with_llm(item["title"], item["summary"], primary)}
+
+        with ThreadPoolExecutor(max_workers=len(others) or 1) as pool:
+            persona_posts = {persona: pool.submit(_persona_post, item, persona) for persona in others}
+            with STAGE_LIMITS["image"], stage_deadline("image"):
+                print("🎨 Генерирую картинку...")
+                image, img_prompt = generate_image_with_hf(posts[primary][1])
+            posts.update({persona: post.result() for persona, post in persona_posts.items()})
+
+        with STAGE_LIMITS["telegram"], stage_deadline("telegram"):
+            print("📤 Постим в Telegram...")
+            delivered = publish_to_channels(publish, {persona: text for persona, (text, _) in posts.items()}, image)
 
         print("✅ Успешно опубликовано!")
+        result = "ok"
     except Exception as e:
         print(f"❌ Ошибка: {e}")
-        # Обнови fallback, если generate_post_with_llm возвращает кортеж даже в случае ошибки
-        # Но если в новой функции ошибка -> возвращается (text, ""), то можно так:
-        # Но fallback_text сейчас строка, а не кортеж, так что, если новая функция крашится,
-        # управление перейдёт сюда.
-        fallback_text = f"[⚠️ Ошибка в генерации]\n\n{full_output[:4000] if 'full_output' in locals() else item['title']}"
-        # Но full_output больше не определена в этом скоупе. Лучше так:
         fallback_text = f"[⚠️ Ошибка в генерации]\n\n{item['title']}"
-        send_to_telegram(fallback_text)
+        try:
+            with STAGE_LIMITS["telegram"], stage_deadline("telegram"):
+                publish_to_channels(publish, {channel["persona"]: fallback_text for channel in CHANNELS})
+            result = "fallback"
+        except Exception as e:
+            print(f"❌ Не удалось опубликовать даже заглушку: {e}")
+            result = "failed"
+
+    METRICS.incr("posts_total", result=result)
+    if result == "failed":
+        return False
+    if result == "ok":
+        # В историю — только сгенерированные (не заглушки) тексты, дошедшие до своих каналов
+        for persona in {channel["persona"] for channel in CHANNELS if channel["chat_id"] in delivered}:
+            text, prompt = posts[persona]
+            if prompt:
+                save_history(text, topic=item["title"], persona=persona)
+        if image:
+            save_image_prompt_to_history(img_prompt)
+    remember_posted_story(item)
+    return True
+
+def run_once(fetch=True, limit=None, publish=None):
+    """
+    Один проход: свежие новости + очередь → сюжеты → до limit (POSTS_PER_RUN) публикаций параллельно,
+    остальные сюжеты (и те, что не удалось отправить) остаются в очереди на следующий запуск.
+    Возвращает число сюжетов, дошедших хотя бы в один канал.
+    fetch=False — работаем только с очередью (команда post), limit=0 — только пополняем очередь (fetch).
+    Весь проход укладывается в RUN_DEADLINE_SECONDS: время на финальную запись в Gist зарезервировано.
+    """
+    global RUN_DEADLINE
+    RUN_DEADLINE = Deadline(RUN_DEADLINE_SECONDS - STAGE_BUDGETS["gist"])
+    limit = POSTS_PER_RUN if limit is None else limit
+    print("🔍 Загружаем уже обработанные новости из Gist...")
+    with stage_deadline("gist"):
+        STATE.load()  # в режиме демона — дешёвая проверка по ETag вместо полной загрузки
+    seen_titles = load_seen()
 
+    news = []
+    if fetch:
+        print("🔍 Ищу свежие политические новости...")
+        with stage_deadline("feeds"):
+            news = fetch_political_news(seen_titles, hours=1)
+    # Свежие новости впереди очереди: при равном score выигрывают они
+    stories = pick_new_stories(news + load_backlog())
+    batch, rest = stories[:limit], stories[limit:]
+    METRICS.gauge("stories_batch", len(batch))
+    METRICS.gauge("stories_backlog", len(rest))
+    save_backlog(rest)
     save_seen(seen_titles)
 
-print("🏁 Скрипт завершён. Всего обработано новостей:", len(news))
+    posted = []
+    if batch:
+        ensure_channels()
+        if rest:
+            print(f"📥 В очереди осталось сюжетов: {len(rest)}")
+        with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+            posted = list(pool.map(functools.partial(process_story, publish=publish), batch))
+        failed = [item for item, ok in zip(batch, posted) if not ok]
+        if failed:
+            # Неотправленные сюжеты — в начало очереди: следующий запуск попробует их снова
+            print(f"📥 Не опубликовано, возвращаю в очередь: {len(failed)}")
+            save_backlog(failed + rest)
+    elif limit == 0:
+        print(f"📥 Сюжетов в очереди: {len(rest)}")
+        for item in rest:
+            print(f"   [{item['score']}] {item['title']} — {item['link']}")
+    else:
+        print("😴 Нет свежих новостей за последний час.")
+
+    with stage_deadline("gist", final=True):
+        STATE.commit()
+    print("🏁 Скрипт завершён. Всего обработано новостей:", len(news))
+    return sum(posted)
+
+# === DAEMON ===
+DAEMON_INTERVAL_MINUTES = float(os.environ.get("DAEMON_INTERVAL_MINUTES", "60"))
+STOP = threading.Event()
+
+def run_daemon(interval_minutes=DAEMON_INTERVAL_MINUTES):
+    """
+    Резидентный режим: цикл «новости → генерация → пост» каждые interval_minutes.
+    Импорты, HTTP-соединения, клиенты инференса и снимок Gist живут между циклами.
+    Останавливается по SIGTERM/SIGINT после текущего цикла.
+    """
+    signal.signal(signal.SIGTERM, lambda *_: STOP.set())
+    signal.signal(signal.SIGINT, lambda *_: STOP.set())
+    print(f"🕰️ Режим демона: цикл каждые {interval_minutes:g} мин")
+    while not STOP.is_set():
+        started = time.monotonic()
+        METRICS.reset()
+        try:
+            run_once()
+        except Exception as e:
+            print(f"❌ Ошибка цикла: {e}")
+        METRICS.write()
+        STOP.wait(max(0.0, interval_minutes * 60 - (time.monotonic() - started)))
+    print("👋 Демон остановлен")
+
+# === CLI ===
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py", description="Vitok News Bot")
+    dry_run_help = "ничего не писать в Gist и не отправлять в Telegram"
+    parser.add_argument("--dry-run", action="store_true", help=dry_run_help)
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    run = commands.add_parser("run", help="полный цикл: ленты → генерация → Telegram (по умолчанию)")
+    run.add_argument("--daemon", action="store_true", help="работать постоянно, запуская цикл по расписанию")
+    run.add_argument("--interval", type=float, default=DAEMON_INTERVAL_MINUTES,
+                     help="интервал между циклами в минутах (для --daemon)")
+
+    commands.add_parser("fetch", help="только ленты: новые сюжеты попадают в очередь, без генерации")
+
+    generate = commands.add_parser("generate", help="полный цикл, но пост печатается в консоль, а не в Telegram; "
+                                                    "состояние в Gist не меняется (всегда --dry-run)")
+    generate.add_argument("--output", metavar="FILE", help="сохранить картинку в файл")
+
+    post = commands.add_parser("post", help="опубликовать сюжеты из очереди, не читая ленты")
+    post.add_argument("--limit", type=int, default=None, help="сколько сюжетов опубликовать (POSTS_PER_RUN)")
+
+    # Флаг принимается и до, и после команды; SUPPRESS — чтобы подкоманда не затирала значение общего флага
+    for command in (run, commands.choices["fetch"], generate, post):
+        command.add_argument("--dry-run", action="store_true", default=argparse.SUPPRESS, help=dry_run_help)
+    return parser
+
+def main(argv=None):
+    global DRY_RUN
+    args = build_parser().parse_args(argv)
+    command = args.command or "run"
+    # generate только показывает пост: сюжет не помечается опубликованным и не уходит из очереди
+    DRY_RUN = args.dry_run or command == "generate"
+
+    if command == "fetch":
+        run_once(limit=0)
+    elif command == "generate":
+        run_once(publish=functools.partial(print_post, image_path=args.output))
+    elif command == "post":
+        run_once(fetch=False, limit=args.limit)
+    elif getattr(args, "daemon", False):
+        run_daemon(args.interval)
+        return
+    else:
+        run_once()
+    METRICS.write()
+
+instrument_module(globals())
+
+# === MAIN ===
+if __name__ == "__main__":
+    main()